@@ -0,0 +1,70 @@
+import argparse
+import asyncio
+import logging
+from logging import INFO
+from sqlalchemy import text
+from models import engine
+
+
+# Настройка логирования
+def __config_logger():
+    FORMAT = '[%(levelname)s] %(asctime)s : %(message)s | %(filename)s'
+    logging.basicConfig(level=INFO,
+                        format=FORMAT,
+                        datefmt='%d-%m-%y - %H:%M:%S')
+
+
+logger = logging.getLogger()
+
+# Записи, повторяющие предыдущую цену того же товара; от каждой серии одинаковых цен остаётся первая запись
+DUPLICATES_SQL = """
+    SELECT id FROM (
+        SELECT id, price, LAG(price) OVER (PARTITION BY item_id ORDER BY recorded_at, id) AS previous_price
+        FROM price_history
+        WHERE item_id = ANY(:item_ids)
+    ) runs
+    WHERE price = previous_price
+"""
+
+
+# Однократное сжатие истории цен: удаляет подряд идущие записи с одинаковой ценой.
+# Товары обрабатываются пачками, каждая пачка - отдельная транзакция
+async def compact_history(batch_size, dry_run):
+    async with engine.connect() as conn:
+        result = await conn.execute(text("SELECT DISTINCT item_id FROM price_history ORDER BY item_id"))
+        item_ids = result.scalars().all()
+    if not item_ids:
+        logger.info("История цен пуста")
+        return
+
+    total = 0
+    for i in range(0, len(item_ids), batch_size):
+        params = {'item_ids': item_ids[i:i + batch_size]}
+        async with engine.begin() as conn:
+            if dry_run:
+                result = await conn.execute(text(f"SELECT COUNT(*) FROM ({DUPLICATES_SQL}) duplicates"), params)
+                removed = result.scalar()
+            else:
+                result = await conn.execute(text(f"DELETE FROM price_history WHERE id IN ({DUPLICATES_SQL})"), params)
+                removed = result.rowcount
+        total += removed
+        logger.info(f"Товары {i + 1}-{i + len(params['item_ids'])} из {len(item_ids)}: повторяющихся записей - {removed}")
+
+    action = "Будет удалено" if dry_run else "Удалено"
+    logger.info(f"{action} записей истории: {total}")
+
+
+async def main(batch_size, dry_run):
+    try:
+        await compact_history(batch_size, dry_run)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    __config_logger()
+    parser = argparse.ArgumentParser(description="Сжатие истории цен: удаление повторов одинаковой цены")
+    parser.add_argument('--batch-size', type=int, default=1000, help="товаров в одной транзакции")
+    parser.add_argument('--dry-run', action='store_true', help="только посчитать записи, ничего не удаляя")
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size, args.dry_run))
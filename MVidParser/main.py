@@ -1,10 +1,30 @@
 import asyncio
 import aiohttp
+import hashlib
+import itertools
+import json
+import os
+import socket
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import random
+from sqlalchemy import DateTime, Float, bindparam, case, func, insert, text, update
 from sqlalchemy.future import select
-from models import AsyncSessionLocal, Product, PriceHistory, init_db
+from db import connect_listener, pool_metrics
+from models import AsyncSessionLocal, CatalogItem, PriceHistory, engine, init_db
 import logging
 from logging import INFO
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 # Настройка логирования
 def __config_logger():
@@ -19,6 +39,246 @@ def __config_logger():
 
 logger = logging.getLogger()
 
+# Параметры обновления товаров
+CONCURRENCY = int(os.getenv('PARSER_CONCURRENCY', '10'))  # одновременных обработчиков
+HOST_RATE_LIMIT = float(os.getenv('PARSER_HOST_RATE_LIMIT', '5'))  # запросов в секунду на хост, 0 - без ограничения
+QUEUE_SIZE = int(os.getenv('PARSER_QUEUE_SIZE', str(CONCURRENCY * 2)))  # размер очередей между этапами
+PRICE_BATCH_SIZE = int(os.getenv('PARSER_PRICE_BATCH_SIZE', '50'))  # товаров в одном запросе цен
+WRITE_CHUNK_SIZE = int(os.getenv('PARSER_WRITE_CHUNK_SIZE', '500'))  # результатов в одной транзакции записи
+FLUSH_INTERVAL = float(os.getenv('PARSER_FLUSH_INTERVAL', '1'))  # секунд до записи неполной пачки
+DECODE_WORKERS = int(os.getenv('PARSER_DECODE_WORKERS', str(os.cpu_count() or 1)))  # процессов разбора JSON, 0 - в цикле событий
+NEW_ITEMS_POLL_INTERVAL = float(os.getenv('PARSER_NEW_ITEMS_POLL_INTERVAL', '60'))  # секунд между проверками новых товаров
+
+# Адаптивное расписание: у каждого товара свой интервал обновления, он сокращается вдвое,
+# если цена изменилась, и растёт в полтора раза, если нет
+REFRESH_MIN_INTERVAL = int(os.getenv('PARSER_REFRESH_MIN_INTERVAL', '900'))  # секунд
+REFRESH_MAX_INTERVAL = int(os.getenv('PARSER_REFRESH_MAX_INTERVAL', '86400'))  # секунд
+REFRESH_JITTER = 0.1  # случайный разброс срока, чтобы обновления не собирались в одну волну
+SCHEDULER_TICK = float(os.getenv('PARSER_SCHEDULER_TICK', '5'))  # секунд между проверками расписания
+CLAIM_BATCH_SIZE = int(os.getenv('PARSER_CLAIM_BATCH_SIZE', str(PRICE_BATCH_SIZE * CONCURRENCY)))  # товаров за раз
+
+# Несколько воркеров парсера делят товары арендой: взятый товар закреплён за воркером на LEASE_TTL секунд.
+# Аренда снимается при записи цены, а аренды упавшего воркера истекают и товары берут другие
+WORKER_ID = os.getenv('PARSER_WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = int(os.getenv('PARSER_LEASE_TTL', '600'))  # секунд
+
+# Канал уведомлений о записи новых данных каталога (по нему API и бот сбрасывают кэш);
+# в payload - id изменившихся товаров через запятую
+CATALOG_UPDATES_CHANNEL = 'catalog_updates'
+NOTIFY_PAYLOAD_LIMIT = 7900  # байт; PostgreSQL ограничивает payload 8000 байтами
+# Канал уведомлений о новых подписках от API и бота; в payload - id товара или пустая строка
+NEW_ITEMS_CHANNEL = 'new_catalog_items'
+
+# Приоритеты заданий: новые товары обрабатываются раньше планового обновления
+PRIORITY_NEW = 0
+PRIORITY_ROUTINE = 1
+
+# Режим записи истории цен: all - каждый проход, changes - только при изменении цены
+HISTORY_MODE = os.getenv('PARSER_HISTORY_MODE', 'all')
+# В режиме changes: через сколько часов записать неизменившуюся цену повторно, 0 - не записывать
+HISTORY_HEARTBEAT_HOURS = float(os.getenv('PARSER_HISTORY_HEARTBEAT_HOURS', '0'))
+
+# Через сколько часов повторно загружать описание товара (название, рейтинг, описание), 0 - только для новых товаров
+DETAILS_REFRESH_HOURS = float(os.getenv('PARSER_DETAILS_REFRESH_HOURS', '0'))
+
+# Адрес сайта; для замеров можно указать локальную заглушку (benchmarks/fake_mvideo.py)
+MVIDEO_BASE_URL = os.getenv('PARSER_MVIDEO_BASE_URL', 'https://www.mvideo.ru').rstrip('/')
+
+# Параметры пула соединений HTTP
+HTTP_POOL_SIZE = int(os.getenv('PARSER_HTTP_POOL_SIZE', '100'))  # всего соединений
+HTTP_POOL_PER_HOST = int(os.getenv('PARSER_HTTP_POOL_PER_HOST', str(CONCURRENCY)))  # соединений на хост
+HTTP_KEEPALIVE = float(os.getenv('PARSER_HTTP_KEEPALIVE', '60'))  # секунд удержания простаивающего соединения
+HTTP_DNS_CACHE_TTL = int(os.getenv('PARSER_HTTP_DNS_CACHE_TTL', '300'))  # секунд кэширования DNS
+
+# Устойчивость к сбоям сайта: таймауты, повторы с экспоненциальной задержкой и автомат отключения
+REQUEST_TIMEOUT = float(os.getenv('PARSER_REQUEST_TIMEOUT', '30'))  # секунд на запрос
+RETRY_ATTEMPTS = int(os.getenv('PARSER_RETRY_ATTEMPTS', '3'))  # повторов после неудачного запроса
+RETRY_BASE_DELAY = float(os.getenv('PARSER_RETRY_BASE_DELAY', '1'))  # секунд до первого повтора
+RETRY_MAX_DELAY = float(os.getenv('PARSER_RETRY_MAX_DELAY', '60'))  # секунд, предел задержки
+BREAKER_THRESHOLD = int(os.getenv('PARSER_BREAKER_THRESHOLD', '5'))  # неудач подряд до паузы
+BREAKER_COOLDOWN = float(os.getenv('PARSER_BREAKER_COOLDOWN', '60'))  # секунд паузы
+METRICS_INTERVAL = float(os.getenv('PARSER_METRICS_INTERVAL', '60'))  # секунд между записями метрик в лог
+
+
+# Ограничение частоты запросов к каждому хосту (token bucket)
+class HostRateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._buckets = {}
+        self._locks = {}
+
+    async def acquire(self, url):
+        if self.rate <= 0:
+            return
+
+        host = urlsplit(url).hostname
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            tokens, updated_at = self._buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens < 1:
+                # Ждём, пока в корзине накопится один токен
+                await asyncio.sleep((1 - tokens) / self.rate)
+                now = time.monotonic()
+                tokens = 1
+            self._buckets[host] = (tokens - 1, now)
+
+
+rate_limiter = HostRateLimiter(HOST_RATE_LIMIT)
+
+
+# Автомат отключения: после BREAKER_THRESHOLD неудач подряд запросы к сайту приостанавливаются
+# на BREAKER_COOLDOWN секунд, затем проходит один пробный запрос. Успех возобновляет работу,
+# неудача - снова пауза
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opens = 0
+        self.opened_until = 0.0
+        self.probing = False
+        self._changed = asyncio.Event()
+
+    def state(self):
+        if self.opened_until > time.monotonic():
+            return 'open'
+        return 'half-open' if self.failures >= self.threshold else 'closed'
+
+    # Ожидание, пока запросы к сайту разрешены
+    async def wait(self):
+        while True:
+            delay = self.opened_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif self.failures < self.threshold:
+                return
+            elif not self.probing:
+                self.probing = True
+                return
+            else:
+                await self._changed.wait()
+
+    # Пауза на заданное время, например по заголовку Retry-After
+    def pause(self, seconds):
+        now = time.monotonic()
+        if self.opened_until <= now:
+            self.opens += 1
+            logger.warning(f"Запросы к сайту приостановлены на {seconds:.0f} с")
+        self.opened_until = max(self.opened_until, now + seconds)
+
+    def record_success(self):
+        if self.failures >= self.threshold:
+            logger.info("Запросы к сайту возобновлены")
+        self.failures = 0
+        self._notify()
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.pause(self.cooldown)
+        self._notify()
+
+    # Попытка завершилась без результата: следующий запрос может стать пробным
+    def release(self):
+        self._notify()
+
+    def _notify(self):
+        self.probing = False
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+# Счётчики запросов к сайту: запросы, ответы по статусам, повторы, таймауты, ошибки, суммарное время
+upstream_metrics = Counter()
+
+
+# Задержка из заголовка Retry-After: число секунд или дата
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+# GET-запрос к сайту с таймаутом, повторами и автоматом отключения. Повторяются таймауты, сетевые
+# ошибки, 429 и 5xx: через Retry-After, если сайт его прислал, иначе через случайную задержку
+# до RETRY_BASE_DELAY * 2^попытка. Возвращает статус, тело (только для 200) и заголовки
+# или None, если все попытки не удались
+async def fetch_upstream(session, url, params, headers):
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        await breaker.wait()
+        recorded = False
+        try:
+            await rate_limiter.acquire(url)
+            upstream_metrics['requests'] += 1
+            started_at = time.monotonic()
+            retry_after = None
+            try:
+                async with session.get(url, params=params, headers=headers) as response:
+                    upstream_metrics[f'status_{response.status}'] += 1
+                    if response.status != 429 and response.status < 500:
+                        body = await response.read() if response.status == 200 else None
+                        upstream_metrics['latency_seconds'] += time.monotonic() - started_at
+                        breaker.record_success()
+                        recorded = True
+                        return response.status, body, response.headers
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    logger.warning(f"Сайт ответил {response.status} на запрос {url}")
+            except asyncio.TimeoutError:
+                upstream_metrics['timeouts'] += 1
+                logger.warning(f"Превышено время ожидания ответа на запрос {url}")
+            except aiohttp.ClientError as e:
+                upstream_metrics['errors'] += 1
+                logger.warning(f"Ошибка соединения при запросе {url}: {e}")
+
+            upstream_metrics['latency_seconds'] += time.monotonic() - started_at
+            breaker.record_failure()
+            recorded = True
+        finally:
+            # Непредвиденное исключение или отмена задачи: пробный запрос полуоткрытого автомата
+            # освобождается, иначе остальные обработчики ждали бы его результата бесконечно
+            if not recorded:
+                breaker.release()
+        if retry_after is not None:
+            breaker.pause(retry_after)
+        if attempt == RETRY_ATTEMPTS:
+            break
+        upstream_metrics['retries'] += 1
+        await asyncio.sleep(
+            retry_after if retry_after is not None
+            else random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        )
+
+    upstream_metrics['failures'] += 1
+    return None
+
+
+# Периодическая запись метрик запросов к сайту и пула соединений с базой в лог
+async def report_metrics():
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        requests = upstream_metrics['requests']
+        latency = upstream_metrics['latency_seconds'] / requests if requests else 0
+        statuses = {key: value for key, value in upstream_metrics.items() if key.startswith('status_')}
+        logger.info(
+            f"Запросы к сайту: всего - {requests}, повторов - {upstream_metrics['retries']}, "
+            f"таймаутов - {upstream_metrics['timeouts']}, неудачных - {upstream_metrics['failures']}, "
+            f"среднее время - {latency:.3f} с, автомат - {breaker.state()} (срабатываний - {breaker.opens}), "
+            f"статусы - {statuses}"
+        )
+        logger.info(f"Пул соединений с базой: {pool_metrics(engine)}")
+
 cookies = {
     '__lhash_': 'aa2659c8a18fa628c9773fa7e18a28ff',
     'MVID_REGION_ID': '1',
@@ -108,144 +368,624 @@ cookies = {
 }
 
 
-async def get_product_data(product_url):
-    headers = {
-        'accept': '*/*',
-        'accept-language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-        'priority': 'u=1, i',
-        'referer': product_url,
-        'sec-ch-ua': '"Google Chrome";v="129", "Not=A?Brand";v="8", "Chromium";v="129"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"Windows"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36',
-    }
+headers = {
+    'accept': '*/*',
+    'accept-language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+    'priority': 'u=1, i',
+    'sec-ch-ua': '"Google Chrome";v="129", "Not=A?Brand";v="8", "Chromium";v="129"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-origin',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36',
+}
+
+
+# Общая HTTP-сессия парсера: один пул соединений с keep-alive и кэшем DNS на весь процесс
+def create_http_session():
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_POOL_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+    )
+    return aiohttp.ClientSession(
+        connector=connector, cookies=cookies, headers=headers,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+    )
+
 
-    product_id = headers['referer'].rsplit('-', 1)[-1]
+# Разбор JSON: orjson, если установлен, иначе стандартный модуль
+def json_loads(body):
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+# Ответ сайта, ожидающий разбора: extract выполняется в пуле процессов (принимает и возвращает
+# только простые значения), build превращает извлечённые данные в результаты для записи
+RawResponse = namedtuple('RawResponse', ['payload', 'body', 'extract', 'build'])
+
+
+# Ответ 304: описание не изменилось с прошлой загрузки
+NOT_MODIFIED = object()
+
+
+# Загрузка описания товара; разбор выполняется отдельно, см. extract_product_details.
+# Если сохранены валидаторы прошлого ответа, запрос условный и может вернуть NOT_MODIFIED;
+# иначе возвращает тело ответа и его валидаторы
+async def get_product_data(session, product_id, product_url, etag=None, last_modified=None):
     params_product = {
         'multioffer': 'true',
         'productId': product_id,
     }
+    request_headers = {'referer': product_url}
+    if etag:
+        request_headers['if-none-match'] = etag
+    if last_modified:
+        request_headers['if-modified-since'] = last_modified
 
-    try:
-        async with aiohttp.ClientSession(cookies=cookies) as session:
-            async with session.get('https://www.mvideo.ru/bff/product-details', params=params_product,
-                                   headers=headers) as response:
-                if response.status != 200:
-                    logger.error(f"Ошибка при получении данных продукта: {response.status}")
-                    return None
-                data = await response.json()
-
-        product_name = data['body']['name']
-        product_rating = data['body']['rating']['star']
-        product_description = data['body']['description']
-        logger.info(f"Получены данные продукта: {product_name}, рейтинг: {product_rating}")
-        return product_name, product_rating, product_description
-    except Exception as e:
-        logger.error(f"Ошибка при запросе данных продукта: {e}")
+    response = await fetch_upstream(session, f'{MVIDEO_BASE_URL}/bff/product-details',
+                                    params_product, request_headers)
+    if response is None:
         return None
+    status, body, response_headers = response
+    if status == 304:
+        return NOT_MODIFIED
+    if status != 200:
+        logger.error(f"Ошибка при получении данных продукта: {status}")
+        return None
+    return body, response_headers.get('ETag'), response_headers.get('Last-Modified')
 
 
-async def get_product_price(product_url):
-    headers = {
-        'accept': '*/*',
-        'accept-language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-        'priority': 'u=1, i',
-        'referer': product_url,
-        'sec-ch-ua': '"Google Chrome";v="129", "Not=A?Brand";v="8", "Chromium";v="129"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"Windows"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36',
-    }
+# Из описания товара нужны только название, рейтинг и текст описания; хэш от них
+# позволяет заметить изменения, даже если сайт не отдаёт валидаторы
+def extract_product_details(body):
+    data = json_loads(body)['body']
+    product_data = data['name'], data['rating']['star'], data['description']
+    content_hash = hashlib.sha256(json.dumps(product_data, ensure_ascii=False).encode()).hexdigest()
+    return product_data, content_hash
 
-    product_id = headers['referer'].rsplit('-', 1)[-1]
 
+# Загрузка цен сразу для нескольких товаров; разбор выполняется отдельно, см. extract_prices
+async def get_products_prices(session, product_ids):
     params_price = {
         'addBonusRubles': 'true',
         'isPromoApplied': 'true',
-        'productIds': product_id,
+        'productIds': ','.join(product_ids),
+    }
+
+    response = await fetch_upstream(session, f'{MVIDEO_BASE_URL}/bff/products/prices',
+                                    params_price, {'referer': f'{MVIDEO_BASE_URL}/'})
+    if response is None:
+        return None
+    status, body, _ = response
+    if status != 200:
+        logger.error(f"Ошибка при получении цен: {status}")
+        return None
+    return body
+
+
+# Из ответа с ценами нужна только цена продажи; возвращает словарь {id товара: цена}
+def extract_prices(body):
+    prices = {}
+    for material_price in json_loads(body)['body'].get('materialPrices') or []:
+        price = material_price.get('price') or {}
+        product_id = price.get('productId') or material_price.get('productId')
+        if product_id is None or price.get('salePrice') is None:
+            continue
+        prices[str(product_id)] = price['salePrice']
+    return prices
+
+
+# Получение описания товара (выполняется в обработчике, без обращения к БД)
+async def fetch_details(session, item):
+    logger.info(f"Обработка товара {item.id}: {item.url}")
+    response = await get_product_data(session, item.id, item.url, item.details_etag, item.details_last_modified)
+    if response is None:
+        logger.warning(f"Не удалось получить данные для товара: {item.url}")
+        return []
+    if response is NOT_MODIFIED:
+        # Записывается только время проверки
+        return [(item, {}, None)]
+    body, etag, last_modified = response
+    return [RawResponse((item, etag, last_modified), body, extract_product_details, build_details)]
+
+
+# Результат для записи по разобранному описанию товара: новые валидаторы и,
+# если содержимое изменилось, название, рейтинг и описание
+def build_details(payload, data):
+    item, etag, last_modified = payload
+    product_data, content_hash = data
+    details = {'details_etag': etag, 'details_last_modified': last_modified, 'details_hash': content_hash}
+    if content_hash != item.details_hash:
+        logger.info(f"Получены данные продукта: {product_data[0]}, рейтинг: {product_data[1]}")
+        details.update(zip(('name', 'rating', 'description'), product_data))
+    return [(item, details, None)]
+
+
+# Получение цен для нескольких товаров одним запросом
+async def fetch_prices(session, items):
+    body = await get_products_prices(session, [item.id for item in items])
+    if body is None:
+        return build_prices(items, {})
+    return [RawResponse(items, body, extract_prices, build_prices)]
+
+
+# Результаты для записи по разобранным ценам; товары без цены пропускаются
+def build_prices(items, prices):
+    logger.info(f"Получены цены для {len(prices)} из {len(items)} товаров")
+    updates = []
+    for item in items:
+        price = prices.get(item.id)
+        if price is None:
+            logger.warning(f"Не удалось обновить цену для товара: {item.url}")
+            continue
+        updates.append((item, None, price))
+    return updates
+
+
+# Цена из ответа сайта в точности, с которой она хранится в базе
+def as_price(value):
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+
+# Отбор цен для истории в режиме changes: новая цена отличается от последней записанной,
+# истории ещё нет или с последней записи прошло HISTORY_HEARTBEAT_HOURS
+async def select_history_changes(db, prices, recorded_at):
+    result = await db.execute(
+        select(PriceHistory.item_id, PriceHistory.price, PriceHistory.recorded_at)
+        .where(PriceHistory.item_id.in_([row['id'] for row in prices]))
+        .order_by(PriceHistory.item_id, PriceHistory.recorded_at.desc())
+        .distinct(PriceHistory.item_id)
+    )
+    last_recorded = {row.item_id: row for row in result.all()}
+    heartbeat = timedelta(hours=HISTORY_HEARTBEAT_HOURS)
+
+    changes = []
+    for row in prices:
+        last = last_recorded.get(row['id'])
+        if (last is None
+                or last.price != as_price(row['price'])
+                or (HISTORY_HEARTBEAT_HOURS > 0 and recorded_at - last.recorded_at >= heartbeat)):
+            changes.append(row)
+    return changes
+
+
+# Запись цены, статистики цены и следующего срока обновления. Время изменения (updated_at),
+# по которому API строит валидаторы ответов, меняется только у товаров, цена которых изменилась
+price_changed = CatalogItem.price.is_distinct_from(bindparam('new_price'))
+refreshed_at = bindparam('refreshed_at', type_=DateTime)
+next_interval = case(
+    (price_changed, func.greatest(REFRESH_MIN_INTERVAL, CatalogItem.refresh_interval // 2)),
+    else_=func.least(REFRESH_MAX_INTERVAL, CatalogItem.refresh_interval * 3 // 2),
+)
+PRICE_UPDATE = (
+    update(CatalogItem.__table__)
+    .where(CatalogItem.id == bindparam('item_id'))
+    .values(
+        price=bindparam('new_price'),
+        updated_at=case((price_changed, refreshed_at), else_=CatalogItem.updated_at),
+        previous_price=case((price_changed, CatalogItem.price), else_=CatalogItem.previous_price),
+        min_price=func.least(CatalogItem.min_price, bindparam('new_price')),
+        max_price=func.greatest(CatalogItem.max_price, bindparam('new_price')),
+        price_changed_at=case((price_changed, refreshed_at), else_=CatalogItem.price_changed_at),
+        price_checked_at=refreshed_at,
+        refresh_interval=next_interval,
+        lease_owner=None,
+        lease_expires_at=None,
+        next_refresh_at=refreshed_at + func.make_interval(
+            0, 0, 0, 0, 0, 0, next_interval * bindparam('jitter', type_=Float)
+        ),
+    )
+)
+
+
+# Проверка правил оповещений одним запросом для всех снизившихся цен пачки: подходящие правила
+# подписок на эти товары дают записи в alert_outbox. Выполняется до записи цен, пока min_price -
+# исторический минимум без новой цены
+ENQUEUE_PRICE_ALERTS = text("""
+    INSERT INTO alert_outbox (user_id, channel, product_id, rule, old_price, new_price, created_at)
+    SELECT products.user_id, price_alerts.channel, products.id, price_alerts.rule, drops.old_price, drops.new_price,
+           CAST(:now AS TIMESTAMP)
+    FROM unnest(CAST(:item_ids AS VARCHAR[]), CAST(:old_prices AS NUMERIC[]), CAST(:new_prices AS NUMERIC[]))
+         AS drops (item_id, old_price, new_price)
+    JOIN catalog_items ON catalog_items.id = drops.item_id
+    JOIN products ON products.item_id = drops.item_id
+    JOIN price_alerts ON price_alerts.product_id = products.id
+    WHERE (price_alerts.rule = 'target'
+           AND drops.new_price <= price_alerts.threshold AND drops.old_price > price_alerts.threshold)
+       OR (price_alerts.rule = 'drop'
+           AND (drops.old_price - drops.new_price) * 100 >= price_alerts.threshold * drops.old_price)
+       OR (price_alerts.rule = 'low' AND drops.new_price < LEAST(catalog_items.min_price, drops.old_price))
+""")
+
+
+# Оповещения о снижении цен пачки; возвращает число добавленных оповещений
+async def enqueue_price_alerts(db, updates, recorded_at):
+    drops = [
+        (item.id, item.price, as_price(price)) for item, _, price in updates
+        if price is not None and item.price is not None and as_price(price) < item.price
+    ]
+    if not drops:
+        return 0
+
+    result = await db.execute(ENQUEUE_PRICE_ALERTS, {
+        'now': recorded_at,
+        'item_ids': [item_id for item_id, _, _ in drops],
+        'old_prices': [old_price for _, old_price, _ in drops],
+        'new_prices': [new_price for _, _, new_price in drops],
+    })
+    return result.rowcount
+
+
+# Средняя цена за 30 дней взвешена временем: проверки учащаются после изменения цены, и среднее
+# по проверкам переоценивало бы неспокойные периоды. При каждой проверке прежняя цена добавляется
+# к суммам текущего дня с весом - числом секунд с прошлой проверки (не больше PRICE_HOLD_LIMIT:
+# товар мог долго стоять без подписчиков). Поэтому запись идёт до записи новой цены
+PRICE_HOLD_LIMIT = int(REFRESH_MAX_INTERVAL * (1 + REFRESH_JITTER)) + LEASE_TTL  # секунд
+ADD_DAILY_PRICES = text("""
+    INSERT INTO price_daily_stats AS daily (item_id, day, price_seconds, seconds)
+    SELECT id, CAST(:day AS DATE), price * held.seconds, held.seconds
+    FROM catalog_items, LATERAL (
+        SELECT CAST(LEAST(
+            EXTRACT(EPOCH FROM CAST(:now AS TIMESTAMP) - price_checked_at), CAST(:hold_limit AS INTEGER)
+        ) AS INTEGER) AS seconds
+    ) AS held
+    WHERE id = ANY(CAST(:item_ids AS VARCHAR[]))
+      AND price IS NOT NULL AND price_checked_at IS NOT NULL AND held.seconds > 0
+    ON CONFLICT (item_id, day) DO UPDATE
+    SET price_seconds = daily.price_seconds + EXCLUDED.price_seconds, seconds = daily.seconds + EXCLUDED.seconds
+""")
+# Средняя пересчитывается по 30 строкам на товар, суммы старше 30 дней удаляются. Пока цена
+# не продержалась ни секунды (первая проверка товара), средняя равна ей самой. Записываются
+# и возвращаются только изменившиеся средние
+UPDATE_AVERAGE_PRICES = text("""
+    WITH expired AS (
+        DELETE FROM price_daily_stats
+        WHERE item_id = ANY(CAST(:item_ids AS VARCHAR[])) AND day <= CAST(:day AS DATE) - 30
+    ), averages AS (
+        SELECT id, ROUND(COALESCE((
+            SELECT SUM(price_seconds) / NULLIF(SUM(seconds), 0)
+            FROM price_daily_stats
+            WHERE item_id = catalog_items.id AND day > CAST(:day AS DATE) - 30
+        ), price), 2) AS avg_price
+        FROM catalog_items
+        WHERE id = ANY(CAST(:item_ids AS VARCHAR[]))
+    )
+    UPDATE catalog_items SET avg_price_30d = averages.avg_price
+    FROM averages
+    WHERE catalog_items.id = averages.id AND catalog_items.avg_price_30d IS DISTINCT FROM averages.avg_price
+    RETURNING catalog_items.id
+""")
+
+
+async def add_daily_prices(db, item_ids, recorded_at):
+    await db.execute(ADD_DAILY_PRICES, {
+        'day': recorded_at.date(), 'now': recorded_at, 'hold_limit': PRICE_HOLD_LIMIT, 'item_ids': item_ids,
+    })
+
+
+# Возвращает id товаров, средняя цена которых изменилась
+async def update_average_prices(db, item_ids, recorded_at):
+    result = await db.execute(UPDATE_AVERAGE_PRICES, {'day': recorded_at.date(), 'item_ids': item_ids})
+    return result.scalars().all()
+
+
+# Уведомления об изменившихся товарах: id делятся на payload допустимой длины
+def catalog_update_payloads(item_ids):
+    payloads = []
+    current = []
+    length = 0
+    for item_id in sorted(item_ids):
+        if current and length + len(item_id) + 1 > NOTIFY_PAYLOAD_LIMIT:
+            payloads.append(','.join(current))
+            current, length = [], 0
+        current.append(item_id)
+        length += len(item_id) + 1
+    if current:
+        payloads.append(','.join(current))
+    return payloads
+
+
+# Запись накопленных результатов одной транзакцией: пакетные UPDATE и INSERT вместо построчных
+async def save_updates(db, updates):
+    recorded_at = datetime.utcnow()
+    # Время изменения (updated_at) меняется, только если изменилось само описание
+    details = [
+        {'id': item.id, 'details_refreshed_at': recorded_at, **product_data,
+         **({'updated_at': recorded_at} if 'name' in product_data else {})}
+        for item, product_data, _ in updates if product_data is not None
+    ]
+    changed_details = sum('name' in row for row in details)
+    prices = [{'id': item.id, 'price': price} for item, _, price in updates if price is not None]
+    # Кэши API и бота сбрасываются только для товаров, у которых изменилось то, что видят пользователи:
+    # описание, цена (сравнивается с ценой на момент захвата - пока товар в аренде, её никто не меняет),
+    # средняя цена или история
+    changed_items = {
+        item.id for item, product_data, price in updates
+        if (product_data is not None and 'name' in product_data)
+        or (price is not None and as_price(price) != item.price)
     }
 
     try:
-        async with aiohttp.ClientSession(cookies=cookies) as session:
-            async with session.get('https://www.mvideo.ru/bff/products/prices', params=params_price,
-                                   headers=headers) as response:
-                if response.status != 200:
-                    logger.error(f"Ошибка при получении цены: {response.status}")
-                    return None
-                data_price = await response.json()
-
-        product_price = data_price['body']['materialPrices'][0]['price']['salePrice']
-        logger.info(f"Получена цена продукта: {product_price}")
-        return product_price
+        history = []
+        alerts = 0
+        if details:
+            await db.execute(update(CatalogItem), details)
+        if prices:
+            # Правила проверяются до записи цен, чтобы исторический минимум не включал новую цену
+            alerts = await enqueue_price_alerts(db, updates, recorded_at)
+            # Товар может попасть в пачку дважды - суммы за день пополняются по нему один раз
+            item_ids = list({row['id'] for row in prices})
+            await add_daily_prices(db, item_ids, recorded_at)
+            await db.execute(
+                PRICE_UPDATE,
+                [
+                    {'item_id': row['id'], 'new_price': row['price'], 'refreshed_at': recorded_at,
+                     'jitter': random.uniform(1 - REFRESH_JITTER, 1 + REFRESH_JITTER)}
+                    for row in prices
+                ]
+            )
+            changed_items.update(await update_average_prices(db, item_ids, recorded_at))
+            history = await select_history_changes(db, prices, recorded_at) if HISTORY_MODE == 'changes' else prices
+            changed_items.update(row['id'] for row in history)
+        if history:
+            await db.execute(
+                insert(PriceHistory),
+                [{'item_id': row['id'], 'price': row['price'], 'recorded_at': recorded_at} for row in history]
+            )
+        # Уведомление доставляется подписчикам только после фиксации транзакции
+        for payload in catalog_update_payloads(changed_items):
+            await db.execute(select(func.pg_notify(CATALOG_UPDATES_CHANNEL, payload)))
+        await db.commit()
+        logger.info(f"Сохранено: описаний - {changed_details} из {len(details)}, цен - {len(prices)}, "
+                    f"записей истории - {len(history)}, оповещений - {alerts}, "
+                    f"изменившихся товаров - {len(changed_items)}")
     except Exception as e:
-        logger.error(f"Ошибка при запросе цены: {e}")
-        return None
+        await db.rollback()
+        logger.error(f"Ошибка при сохранении пакета из {len(updates)} результатов: {e}")
 
 
-# Функция для обновления информации о товаре
-async def update_product_data():
-    async with AsyncSessionLocal() as db:
-        try:
-            result = await db.execute(select(Product))
-            products = result.scalars().all()
-
-            for product in products:
-                logger.info(f"Обработка товара: {product.url}")
-                if product.name is None:
-                    product_data = await get_product_data(product.url)
-                    if product_data:
-                        name, rating, description = product_data
-                        price = await get_product_price(product.url)
-
-                        # Обновление данных в базе
-                        product.name = name
-                        product.rating = rating
-                        product.description = description
-                        product.price = price
-
-                        # Сохранение изменений
-                        await db.commit()
-
-                        # Сохранение истории цен
-                        price_history = PriceHistory(product_id=product.id, price=price)
-                        db.add(price_history)
-                    else:
-                        logger.warning(f"Не удалось получить данные для товара: {product.url}")
+# Движок обновления - конвейер из трёх этапов, связанных ограниченными очередями:
+# обработчики запросов к сайту (общая очередь заданий с приоритетами), разбор ответов
+# в пуле процессов и единственный писатель в БД (сессия SQLAlchemy не допускает конкурентного использования)
+class RefreshEngine:
+    def __init__(self, session):
+        self.session = session
+        self.jobs = asyncio.PriorityQueue()
+        self.responses = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.results = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.pool = None
+        # Плановые задания ждут свободного места в очереди, новые товары ставятся без ожидания
+        self.routine_slots = asyncio.Semaphore(QUEUE_SIZE)
+        self._sequence = itertools.count()
+        self._tasks = []
+
+    def start(self):
+        if DECODE_WORKERS > 0:
+            self.pool = ProcessPoolExecutor(max_workers=DECODE_WORKERS)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(CONCURRENCY)]
+        # По два разборщика на процесс, чтобы процессы не простаивали между ответами
+        self._tasks += [asyncio.create_task(self._decoder()) for _ in range(max(1, DECODE_WORKERS * 2))]
+        self._tasks.append(asyncio.create_task(self._writer()))
+
+    # Ожидание, пока все поставленные задания пройдут конвейер и будут записаны
+    async def drain(self):
+        await self.jobs.join()
+        await self.responses.join()
+        await self.results.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+    # Постановка задания в очередь; возвращает future, завершающийся после выполнения запроса
+    async def submit(self, fetch, payload, priority):
+        if priority == PRIORITY_ROUTINE:
+            await self.routine_slots.acquire()
+        done = asyncio.get_running_loop().create_future()
+        await self.jobs.put((priority, next(self._sequence), fetch, payload, done))
+        return done
+
+    async def _worker(self):
+        while True:
+            priority, _, fetch, payload, done = await self.jobs.get()
+            if priority == PRIORITY_ROUTINE:
+                self.routine_slots.release()
+            try:
+                for response in await fetch(self.session, payload):
+                    await (self.responses if isinstance(response, RawResponse) else self.results).put(response)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке задания {fetch.__name__}: {e}")
+            finally:
+                if not done.done():
+                    done.set_result(None)
+                self.jobs.task_done()
+
+    # Разбор JSON занимает процессор, поэтому выполняется в пуле процессов, не блокируя цикл событий
+    async def _decoder(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            response = await self.responses.get()
+            try:
+                if self.pool is None:
+                    data = response.extract(response.body)
                 else:
-                    price = await get_product_price(product.url)
-                    if price:
-                        # Обновление данных в базе
-                        product.price = price
+                    data = await loop.run_in_executor(self.pool, response.extract, response.body)
+                for update in response.build(response.payload, data):
+                    await self.results.put(update)
+            except Exception as e:
+                logger.error(f"Ошибка при разборе ответа {response.extract.__name__}: {e}")
+            finally:
+                self.responses.task_done()
 
-                        # Сохранение изменений
-                        await db.commit()
+    # Результаты копятся и записываются пачками по WRITE_CHUNK_SIZE или раз в FLUSH_INTERVAL;
+    # пока идёт запись, очередь результатов заполняется и притормаживает обработчики
+    async def _writer(self):
+        pending = []
+        while True:
+            try:
+                pending.append(await asyncio.wait_for(self.results.get(), FLUSH_INTERVAL if pending else None))
+                if len(pending) < WRITE_CHUNK_SIZE:
+                    continue
+            except asyncio.TimeoutError:
+                pass
+            async with AsyncSessionLocal() as db:
+                await save_updates(db, pending)
+            for _ in pending:
+                self.results.task_done()
+            pending = []
+
+
+# Постановка товаров в очередь: описание для ещё не загруженных, цены - пачками
+async def submit_items(refresher, items, priority):
+    done = []
+    for item in items:
+        if item.refresh_details:
+            done.append(await refresher.submit(fetch_details, item, priority))
+    for i in range(0, len(items), PRICE_BATCH_SIZE):
+        done.append(await refresher.submit(fetch_prices, items[i:i + PRICE_BATCH_SIZE], priority))
+    return done
+
+
+# Захват товаров в аренду. FOR UPDATE SKIP LOCKED не даёт двум воркерам взять один товар,
+# а товары с действующей арендой пропускаются. Если запрос не удался, товар будет взят снова
+# после истечения аренды. price - цена до обновления (по ней проверяются правила оповещений).
+# В url - ссылка любого из подписчиков; refresh_details - нужно ли
+# загрузить описание (новый товар или прошло DETAILS_REFRESH_HOURS)
+CLAIM_ITEMS_SQL = """
+    WITH claimed AS (
+        SELECT id FROM catalog_items
+        WHERE {condition}
+          AND (lease_expires_at IS NULL OR lease_expires_at <= CAST(:now AS TIMESTAMP))
+        ORDER BY next_refresh_at
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE catalog_items
+    SET lease_owner = :worker_id,
+        lease_expires_at = CAST(:now AS TIMESTAMP) + CAST(:lease_ttl AS INTEGER) * interval '1 second'
+    FROM claimed
+    WHERE catalog_items.id = claimed.id
+    RETURNING catalog_items.id, catalog_items.name, catalog_items.price,
+              catalog_items.details_etag, catalog_items.details_last_modified, catalog_items.details_hash,
+              catalog_items.name IS NULL OR COALESCE(
+                  COALESCE(catalog_items.details_refreshed_at, '-infinity') <= CAST(:details_due AS TIMESTAMP), FALSE
+              ) AS refresh_details,
+              (SELECT MIN(url) FROM products WHERE products.item_id = catalog_items.id) AS url
+"""
+# Товары, срок обновления которых наступил
+CLAIM_DUE_ITEMS = text(CLAIM_ITEMS_SQL.format(condition="next_refresh_at <= CAST(:now AS TIMESTAMP)"))
+# Новые товары (ещё без названия): из уведомлений или, если item_ids не заданы, все
+CLAIM_NEW_ITEMS = text(CLAIM_ITEMS_SQL.format(
+    condition="name IS NULL AND next_refresh_at IS NOT NULL"
+              " AND (CAST(:item_ids AS VARCHAR[]) IS NULL OR id = ANY(CAST(:item_ids AS VARCHAR[])))"
+))
+
+# Товары без подписчиков снимаются с расписания до следующей подписки
+PARK_ITEMS = text(
+    "UPDATE catalog_items SET next_refresh_at = NULL, lease_owner = NULL, lease_expires_at = NULL"
+    " WHERE id = ANY(:item_ids)"
+)
+
+
+# Захват товаров и постановка их в очередь; возвращает число взятых товаров
+async def claim_items(refresher, statement, priority, **params):
+    async with AsyncSessionLocal() as db:
+        now = datetime.utcnow()
+        result = await db.execute(statement, {
+            'now': now, 'limit': CLAIM_BATCH_SIZE,
+            'details_due': now - timedelta(hours=DETAILS_REFRESH_HOURS) if DETAILS_REFRESH_HOURS > 0 else None,
+            'worker_id': WORKER_ID, 'lease_ttl': LEASE_TTL, **params,
+        })
+        claimed = result.all()
+        orphans = [item.id for item in claimed if item.url is None]
+        if orphans:
+            await db.execute(PARK_ITEMS, {'item_ids': orphans})
+        await db.commit()
 
-                        # Сохранение истории цен
-                        price_history = PriceHistory(product_id=product.id, price=price)
-                        db.add(price_history)
-                    else:
-                        logger.warning(f"Не удалось обновить цену для товара: {product.url}")
+    items = [item for item in claimed if item.url is not None]
+    if items:
+        await submit_items(refresher, items, priority)
+    return len(claimed)
 
-            await db.commit()
+
+# Функция для обновления информации о товаре: ставит в очередь товары, срок обновления
+# которых наступил, и возвращает их число
+async def update_product_data(refresher):
+    try:
+        claimed = await claim_items(refresher, CLAIM_DUE_ITEMS, PRIORITY_ROUTINE)
+        if claimed:
+            logger.info(f"Товаров к обновлению по расписанию: {claimed}")
+        return claimed
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении данных товара: {e}")
+        return 0
+
+
+# Постановка новых товаров (ещё без названия) в очередь с высшим приоритетом.
+# item_ids - товары из уведомлений; None - проверить все новые товары
+async def submit_new_items(refresher, item_ids=None):
+    while True:
+        claimed = await claim_items(refresher, CLAIM_NEW_ITEMS, PRIORITY_NEW, item_ids=item_ids)
+        if claimed:
+            logger.info(f"Новых товаров в очереди: {claimed}")
+        if claimed < CLAIM_BATCH_SIZE:
+            return
+
+
+# Отслеживание новых подписок: LISTEN new_catalog_items для мгновенной реакции
+# и периодическая проверка на случай потерянных уведомлений
+async def watch_new_items(refresher):
+    notifications = asyncio.Queue()
+    conn = None
+    while True:
+        if conn is None or conn.is_closed():
+            try:
+                conn = await connect_listener('mvid-parser-listener')
+                await conn.add_listener(NEW_ITEMS_CHANNEL, lambda *args: notifications.put_nowait(args[-1]))
+            except Exception as e:
+                logger.error(f"Ошибка подписки на новые товары: {e}")
+                conn = None
+
+        try:
+            payloads = {await asyncio.wait_for(notifications.get(), NEW_ITEMS_POLL_INTERVAL)}
+            # Собираем уведомления о товарах, добавленных почти одновременно
+            await asyncio.sleep(0.2)
+            while not notifications.empty():
+                payloads.add(notifications.get_nowait())
+            item_ids = None if '' in payloads else list(payloads)
+        except asyncio.TimeoutError:
+            item_ids = None
+
+        try:
+            await submit_new_items(refresher, item_ids)
         except Exception as e:
-            logger.error(f"Ошибка при обновлении данных товара: {e}")
+            logger.error(f"Ошибка при постановке новых товаров в очередь: {e}")
 
 
 # Запуск планировщика
 async def run_scheduler():
     await init_db()
-    while True:
+    # Сессия закрывается вместе с пулом соединений при остановке планировщика
+    async with create_http_session() as session:
+        refresher = RefreshEngine(session)
+        refresher.start()
+        watcher = asyncio.create_task(watch_new_items(refresher))
+        reporter = asyncio.create_task(report_metrics())
         try:
-            await update_product_data()
-            await asyncio.sleep(3600)  # Ждём 1 час перед следующим запуском
-        except Exception as e:
-            logger.error(f"Ошибка в планировщике: {e}")
+            while True:
+                # Пока просроченные товары не кончились, следующая пачка берётся сразу:
+                # темп задают очередь и ограничение частоты запросов
+                if await update_product_data(refresher) < CLAIM_BATCH_SIZE:
+                    await asyncio.sleep(SCHEDULER_TICK)
+        finally:
+            watcher.cancel()
+            reporter.cancel()
+            await refresher.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,290 @@
+from sqlalchemy import text
+import logging
+
+
+logger = logging.getLogger()
+
+
+# Проверка наличия столбца в существующей таблице
+async def column_exists(conn, table, column):
+    result = await conn.execute(
+        text("SELECT 1 FROM information_schema.columns WHERE table_name = :table AND column_name = :column"),
+        {'table': table, 'column': column}
+    )
+    return result.first() is not None
+
+
+# ID товара - как в extract_product_id API и бота: число в конце пути ссылки после дефиса,
+# параметры запроса, фрагмент и завершающий слэш не учитываются. Для ссылок другого вида - NULL
+PRODUCT_ITEM_IDS_SQL = [
+    "ALTER TABLE products ADD COLUMN IF NOT EXISTS item_id VARCHAR(64)",
+    """
+    UPDATE products
+    SET item_id = substring(rtrim(regexp_replace(url, '[?#].*$', ''), '/') FROM '-([0-9]{1,64})$')
+    WHERE item_id IS NULL
+    """,
+]
+
+# Перенос данных о товарах из подписок (products) в общий каталог (catalog_items).
+# История цен, продублированная по подписчикам, сводится к истории одной подписки на товар
+CATALOG_ITEMS_SQL = [
+    """
+    INSERT INTO catalog_items (id, name, description, rating, price, updated_at, next_refresh_at)
+    SELECT DISTINCT ON (item_id) item_id, name, description, rating, price, timezone('utc', now()),
+           timezone('utc', now()) + random() * interval '1 hour'
+    FROM products
+    WHERE item_id IS NOT NULL
+    ORDER BY item_id, name IS NULL, id DESC
+    ON CONFLICT (id) DO NOTHING
+    """,
+    "ALTER TABLE price_history ADD COLUMN IF NOT EXISTS item_id VARCHAR(64)",
+    """
+    UPDATE price_history SET item_id = products.item_id
+    FROM products
+    WHERE price_history.product_id = products.id AND price_history.item_id IS NULL
+    """,
+    "DELETE FROM price_history WHERE item_id IS NULL",
+    # Подписки на ссылки без ID товара парсер обновить не может
+    "DELETE FROM products WHERE item_id IS NULL",
+    # Подписчики записывали одни и те же цены каждый со своим временем, поэтому совпадений по времени нет:
+    # остаётся история самой ранней подписки на товар, она же самая длинная
+    """
+    DELETE FROM price_history USING products
+    WHERE price_history.product_id = products.id
+      AND products.id <> (SELECT MIN(first.id) FROM products AS first WHERE first.item_id = products.item_id)
+    """,
+    "ALTER TABLE price_history DROP COLUMN product_id",
+    "ALTER TABLE price_history ALTER COLUMN item_id SET NOT NULL",
+    """
+    ALTER TABLE price_history ADD CONSTRAINT price_history_item_id_fkey
+    FOREIGN KEY (item_id) REFERENCES catalog_items (id)
+    """,
+    "ALTER TABLE products ALTER COLUMN item_id SET NOT NULL",
+    """
+    ALTER TABLE products ADD CONSTRAINT products_item_id_fkey
+    FOREIGN KEY (item_id) REFERENCES catalog_items (id)
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_products_item_id ON products (item_id)",
+    "ALTER TABLE products DROP COLUMN name, DROP COLUMN description, DROP COLUMN rating, DROP COLUMN price",
+]
+
+
+async def migrate_catalog_items(conn):
+    if not await column_exists(conn, 'products', 'name'):
+        return False
+    for statement in PRODUCT_ITEM_IDS_SQL:
+        await conn.execute(text(statement))
+    result = await conn.execute(text("SELECT id, user_id, url FROM products WHERE item_id IS NULL"))
+    for product in result.all():
+        logger.warning(f"Подписка {product.id} пользователя {product.user_id} удалена: "
+                       f"в ссылке нет ID товара: {product.url}")
+    for statement in CATALOG_ITEMS_SQL:
+        await conn.execute(text(statement))
+    return True
+
+
+# Индексы, которых нет в базах, созданных до их появления в моделях
+INDEXES_SQL = {
+    'ix_price_history_item_id_recorded_at': "CREATE INDEX {name} ON price_history (item_id, recorded_at)",
+    'ix_products_user_id_id': "CREATE INDEX {name} ON products (user_id, id)",
+}
+
+
+async def migrate_indexes(conn):
+    result = await conn.execute(
+        text("SELECT indexname FROM pg_indexes WHERE indexname = ANY(:names)"),
+        {'names': list(INDEXES_SQL)}
+    )
+    existing = set(result.scalars().all())
+    missing = [name for name in INDEXES_SQL if name not in existing]
+    for name in missing:
+        await conn.execute(text(INDEXES_SQL[name].format(name=name)))
+    return bool(missing)
+
+
+# Столбцы расписания обновления
+REFRESH_SCHEDULE_SQL = [
+    "ALTER TABLE catalog_items ADD COLUMN refresh_interval INTEGER NOT NULL DEFAULT 3600",
+    "ALTER TABLE catalog_items ADD COLUMN next_refresh_at TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS ix_catalog_items_next_refresh_at ON catalog_items (next_refresh_at)",
+]
+
+# Товары с подписчиками, но без срока обновления, ставятся в расписание; первые запуски
+# равномерно распределяются по часу. Проверяются данные, а не наличие столбца: столбец мог
+# появиться через create_all, а строки - через перенос каталога без срока обновления
+SCHEDULE_UNSCHEDULED_ITEMS_SQL = """
+    UPDATE catalog_items SET next_refresh_at = timezone('utc', now()) + random() * interval '1 hour'
+    WHERE next_refresh_at IS NULL
+      AND EXISTS (SELECT 1 FROM products WHERE products.item_id = catalog_items.id)
+"""
+
+
+async def migrate_refresh_schedule(conn):
+    applied = False
+    if not await column_exists(conn, 'catalog_items', 'next_refresh_at'):
+        for statement in REFRESH_SCHEDULE_SQL:
+            await conn.execute(text(statement))
+        applied = True
+    result = await conn.execute(text(SCHEDULE_UNSCHEDULED_ITEMS_SQL))
+    return applied or result.rowcount > 0
+
+
+LEASES_SQL = [
+    "ALTER TABLE catalog_items ADD COLUMN lease_owner VARCHAR(64)",
+    "ALTER TABLE catalog_items ADD COLUMN lease_expires_at TIMESTAMP",
+]
+
+
+async def migrate_leases(conn):
+    if await column_exists(conn, 'catalog_items', 'lease_owner'):
+        return False
+    for statement in LEASES_SQL:
+        await conn.execute(text(statement))
+    return True
+
+
+DETAILS_VALIDATORS_SQL = [
+    "ALTER TABLE catalog_items ADD COLUMN details_etag VARCHAR(255)",
+    "ALTER TABLE catalog_items ADD COLUMN details_last_modified VARCHAR(64)",
+    "ALTER TABLE catalog_items ADD COLUMN details_hash VARCHAR(64)",
+    "ALTER TABLE catalog_items ADD COLUMN details_refreshed_at TIMESTAMP",
+]
+
+
+async def migrate_details_validators(conn):
+    if await column_exists(conn, 'catalog_items', 'details_hash'):
+        return False
+    for statement in DETAILS_VALIDATORS_SQL:
+        await conn.execute(text(statement))
+    return True
+
+
+# Суммы цен за день, взвешенные временем, по истории за 30 дней: цена записи держалась
+# до следующей записи, а время учитывается в дне, когда закончилось (так же их пополняет парсер).
+# Часть интервала до начала 30-дневного окна отбрасывается
+DAILY_PRICES_SQL = """
+    INSERT INTO price_daily_stats (item_id, day, price_seconds, seconds)
+    SELECT item_id, CAST(held_until AS DATE), SUM(price * seconds), SUM(seconds)
+    FROM (
+        SELECT item_id, price, held_until,
+               CAST(EXTRACT(EPOCH FROM held_until - GREATEST(recorded_at, timezone('utc', now()) - interval '30 days'))
+                    AS INTEGER) AS seconds
+        FROM (
+            SELECT item_id, price, recorded_at,
+                   LEAD(recorded_at) OVER (PARTITION BY item_id ORDER BY recorded_at, id) AS held_until
+            FROM price_history
+            WHERE item_id IN (SELECT id FROM catalog_items WHERE {condition})
+        ) AS history
+        WHERE held_until > timezone('utc', now()) - interval '30 days'
+    ) AS intervals
+    WHERE seconds > 0
+    GROUP BY item_id, CAST(held_until AS DATE)
+    ON CONFLICT DO NOTHING
+"""
+
+# Средняя за 30 дней по суммам за день; без сумм - текущая цена
+AVERAGE_PRICES_SQL = """
+    UPDATE catalog_items
+    SET avg_price_30d = COALESCE((
+        SELECT SUM(price_seconds) / NULLIF(SUM(seconds), 0)
+        FROM price_daily_stats
+        WHERE item_id = catalog_items.id AND day > CAST(timezone('utc', now()) AS DATE) - 30
+    ), price)
+    WHERE {condition}
+"""
+
+# Время последней проверки цены: с него парсер отсчитывает, сколько держалась цена.
+# Для существующих товаров - время последней записи истории
+PRICE_CHECKED_AT_SQL = [
+    "ALTER TABLE catalog_items ADD COLUMN price_checked_at TIMESTAMP",
+    """
+    UPDATE catalog_items
+    SET price_checked_at = (SELECT MAX(recorded_at) FROM price_history WHERE item_id = catalog_items.id)
+    WHERE price IS NOT NULL
+    """,
+]
+
+
+async def migrate_price_checked_at(conn):
+    if await column_exists(conn, 'catalog_items', 'price_checked_at'):
+        return False
+    for statement in PRICE_CHECKED_AT_SQL:
+        await conn.execute(text(statement))
+    return True
+
+
+# Столбцы статистики цен
+PRICE_STATISTICS_SQL = [
+    "ALTER TABLE catalog_items ADD COLUMN previous_price NUMERIC(10, 2)",
+    "ALTER TABLE catalog_items ADD COLUMN min_price NUMERIC(10, 2)",
+    "ALTER TABLE catalog_items ADD COLUMN max_price NUMERIC(10, 2)",
+    "ALTER TABLE catalog_items ADD COLUMN avg_price_30d NUMERIC(10, 2)",
+    "ALTER TABLE catalog_items ADD COLUMN price_changed_at TIMESTAMP",
+]
+
+# Товары с ценой, но без статистики: столбцы могли появиться через create_all, поэтому
+# проверяются данные. Парсер заполняет min_price при первой записи цены, так что после
+# заполнения по истории повторно эти товары не выбираются
+MISSING_PRICE_STATISTICS = "catalog_items.min_price IS NULL AND catalog_items.price IS NOT NULL"
+
+# Статистика цен таких товаров заполняется по накопленной истории; min_price - последней,
+# потому что по ней отбираются товары
+PRICE_STATISTICS_BACKFILL_SQL = [
+    f"""
+    UPDATE catalog_items
+    SET previous_price = changes.previous_price, price_changed_at = changes.recorded_at
+    FROM (
+        SELECT DISTINCT ON (item_id) item_id, previous_price, recorded_at
+        FROM (
+            SELECT item_id, price, recorded_at, id,
+                   LAG(price) OVER (PARTITION BY item_id ORDER BY recorded_at, id) AS previous_price
+            FROM price_history
+            WHERE item_id IN (SELECT id FROM catalog_items WHERE {MISSING_PRICE_STATISTICS})
+        ) AS history
+        WHERE previous_price IS DISTINCT FROM price
+        ORDER BY item_id, recorded_at DESC, id DESC
+    ) AS changes
+    WHERE catalog_items.id = changes.item_id
+    """,
+    DAILY_PRICES_SQL.format(condition=MISSING_PRICE_STATISTICS),
+    AVERAGE_PRICES_SQL.format(condition=MISSING_PRICE_STATISTICS),
+    f"""
+    UPDATE catalog_items
+    SET min_price = LEAST((SELECT MIN(price) FROM price_history WHERE item_id = catalog_items.id), price),
+        max_price = GREATEST((SELECT MAX(price) FROM price_history WHERE item_id = catalog_items.id), price)
+    WHERE {MISSING_PRICE_STATISTICS}
+    """,
+]
+
+
+async def migrate_price_statistics(conn):
+    applied = False
+    if not await column_exists(conn, 'catalog_items', 'min_price'):
+        for statement in PRICE_STATISTICS_SQL:
+            await conn.execute(text(statement))
+        applied = True
+    result = await conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM catalog_items WHERE {MISSING_PRICE_STATISTICS})"))
+    if result.scalar():
+        for statement in PRICE_STATISTICS_BACKFILL_SQL:
+            await conn.execute(text(statement))
+        applied = True
+    return applied
+
+
+# Миграции существующей базы по порядку; каждая сама проверяет, нужна ли она,
+# поэтому на новой базе, созданной через create_all, они ничего не делают
+MIGRATIONS = [
+    migrate_catalog_items,
+    migrate_indexes,
+    migrate_refresh_schedule,
+    migrate_leases,
+    migrate_details_validators,
+    migrate_price_checked_at,
+    migrate_price_statistics,
+]
+
+
+async def run_migrations(conn):
+    for migration in MIGRATIONS:
+        if await migration(conn):
+            logger.info(f"Применена миграция базы данных: {migration.__name__}")
@@ -0,0 +1,213 @@
+import asyncio
+import os
+import pickle
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+from db import connect_listener
+import logging
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+
+logger = logging.getLogger()
+
+# Параметры кэша ответов
+CACHE_BACKEND = os.getenv('API_CACHE_BACKEND', 'memory')  # memory - в памяти процесса, redis - общий для воркеров
+CACHE_TTL = float(os.getenv('API_CACHE_TTL', '300'))  # секунд жизни записи
+CACHE_MAX_SIZE = int(os.getenv('API_CACHE_MAX_SIZE', '10000'))  # записей в памяти процесса
+CACHE_REDIS_URL = os.getenv('API_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+# Канал, в который парсер сообщает о записи новых данных каталога
+CATALOG_UPDATES_CHANNEL = 'catalog_updates'
+
+# Закэшированный ответ: готовое тело и дополнительные заголовки
+CachedResponse = namedtuple('CachedResponse', ['body', 'headers'])
+
+
+# Кэш в памяти процесса: TTL и вытеснение давно не использованных записей (LRU).
+# Ключи записей каждого пользователя хранятся отдельно, чтобы сбрасывать их без перебора всего кэша
+class MemoryCacheBackend:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()  # (пользователь, ключ) -> (значение, срок жизни)
+        self._user_keys = defaultdict(set)
+
+    async def get(self, user, key):
+        entry = self._entries.get((user, key))
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[(user, key)]
+            self._forget(user, key)
+            return None
+        self._entries.move_to_end((user, key))
+        return value
+
+    async def set(self, user, key, value):
+        self._entries[(user, key)] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end((user, key))
+        self._user_keys[user].add(key)
+        while len(self._entries) > self.max_size:
+            (evicted_user, evicted_key), _ = self._entries.popitem(last=False)
+            self._forget(evicted_user, evicted_key)
+            self.evictions += 1
+
+    def _forget(self, user, key):
+        keys = self._user_keys.get(user)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[user]
+
+    async def delete_user(self, user):
+        for key in self._user_keys.pop(user, ()):
+            self._entries.pop((user, key), None)
+
+    async def clear(self):
+        self._entries.clear()
+        self._user_keys.clear()
+
+    def size(self):
+        return len(self._entries)
+
+
+# Общий кэш в Redis для нескольких воркеров API; TTL и LRU обеспечивает сам Redis.
+# Ключи записей пользователя перечислены в его множестве-индексе: сброс не требует SCAN,
+# а X-Session-ID не попадает в шаблоны MATCH. Длина ID в ключе делает ключи однозначными
+class RedisCacheBackend:
+    namespace = 'mvid-api:'
+
+    def __init__(self, url, ttl):
+        if redis is None:
+            raise RuntimeError("Для API_CACHE_BACKEND=redis нужен установленный пакет redis")
+        self.ttl = ttl
+        self.evictions = None
+        self._client = redis.from_url(url)
+
+    def _entry_key(self, user, key):
+        return f"{self.namespace}entry:{len(user)}:{user}:{key}"
+
+    def _index_key(self, user):
+        return f"{self.namespace}user:{user}"
+
+    async def get(self, user, key):
+        value = await self._client.get(self._entry_key(user, key))
+        return pickle.loads(value) if value is not None else None
+
+    async def set(self, user, key, value):
+        ttl = int(self.ttl * 1000)
+        entry_key = self._entry_key(user, key)
+        async with self._client.pipeline(transaction=False) as pipeline:
+            pipeline.set(entry_key, pickle.dumps(value), px=ttl)
+            pipeline.sadd(self._index_key(user), entry_key)
+            pipeline.pexpire(self._index_key(user), ttl)
+            await pipeline.execute()
+
+    async def delete_user(self, user):
+        keys = await self._client.smembers(self._index_key(user))
+        await self._client.delete(self._index_key(user), *keys)
+
+    async def clear(self):
+        keys = [key async for key in self._client.scan_iter(match=self.namespace + '*')]
+        if keys:
+            await self._client.delete(*keys)
+
+    def size(self):
+        return None
+
+
+# Кэш с учётом попаданий и промахов. Записи хранятся по X-Session-ID пользователя,
+# чтобы сбрасывать все его записи при добавлении и удалении товаров
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get(self, session_id, key):
+        try:
+            value = await self.backend.get(session_id, key)
+        except Exception as e:
+            logger.error(f"Ошибка при чтении кэша: {e}")
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, session_id, key, value):
+        try:
+            await self.backend.set(session_id, key, value)
+        except Exception as e:
+            logger.error(f"Ошибка при записи в кэш: {e}")
+
+    async def invalidate_user(self, session_id):
+        self.invalidations += 1
+        await self.backend.delete_user(session_id)
+
+    async def invalidate_all(self):
+        self.invalidations += 1
+        await self.backend.clear()
+
+    def metrics(self):
+        requests = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests else None,
+            'invalidations': self.invalidations,
+            'evictions': self.backend.evictions,
+            'size': self.backend.size(),
+        }
+
+
+def create_cache():
+    if CACHE_BACKEND == 'redis':
+        return ResponseCache(RedisCacheBackend(CACHE_REDIS_URL, CACHE_TTL))
+    return ResponseCache(MemoryCacheBackend(CACHE_MAX_SIZE, CACHE_TTL))
+
+
+# Подписчики изменившихся товаров из уведомления парсера
+SUBSCRIBERS_SQL = "SELECT DISTINCT user_id FROM products WHERE item_id = ANY($1::varchar[])"
+
+
+# Сброс записей пользователей, подписанных на изменившиеся товары; пустой payload - сброс всего кэша
+async def invalidate_items(conn, cache, payload):
+    if not payload:
+        await cache.invalidate_all()
+        return
+    for row in await conn.fetch(SUBSCRIBERS_SQL, payload.split(',')):
+        await cache.invalidate_user(row['user_id'])
+
+
+# Сброс кэша по уведомлениям парсера (LISTEN catalog_updates); при потере соединения - переподключение.
+# Уведомления обрабатываются по очереди: соединение asyncpg не выполняет запросы параллельно
+async def listen_for_catalog_updates(cache):
+    while True:
+        try:
+            conn = await connect_listener('mvid-api-listener')
+            notifications = asyncio.Queue()
+            conn.add_termination_listener(lambda _: notifications.put_nowait(None))
+            await conn.add_listener(CATALOG_UPDATES_CHANNEL, lambda *args: notifications.put_nowait(args[-1]))
+            logger.info(f"Подписка на канал {CATALOG_UPDATES_CHANNEL} для сброса кэша")
+            try:
+                while (payload := await notifications.get()) is not None:
+                    await invalidate_items(conn, cache, payload)
+            finally:
+                await conn.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка подписки на обновления каталога: {e}")
+        # Пока подписки нет, уведомления теряются - сбрасываем кэш целиком
+        await cache.invalidate_all()
+        await asyncio.sleep(5)
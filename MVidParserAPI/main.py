@@ -1,10 +1,26 @@
+import asyncio
+import base64
+import hashlib
+import os
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Depends, HTTPException, Request
-from sqlalchemy import delete
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+import numpy as np
+from sqlalchemy import Float, Integer, cast, delete, func, literal, tuple_
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from typing import List
-from models import ProductView, ProductCreate, Product, get_db, PriceHistoryView, PriceHistory, init_db
+from pydantic import TypeAdapter
+from typing import List, Optional
+from cache import CachedResponse, create_cache, listen_for_catalog_updates
+from charts import CHART_MEDIA_TYPES, ChartRenderer
+from db import pool_metrics
+from models import (ProductView, ProductCreate, Product, CatalogItem, get_db, PriceHistoryView, PriceHistory, init_db,
+                    PriceHistoryBucketView, SessionLocal, extract_product_id, ProductBatchCreate, ProductBatchDelete,
+                    ProductBatchResult, upsert_catalog_items, PriceAlert, PriceAlertCreate, PriceAlertView, engine,
+                    AlertOutbox, AlertNotificationView)
 import logging
 from logging import INFO
 
@@ -26,19 +42,93 @@ logger = logging.getLogger()
 __config_logger()
 
 
+# Кэш ответов для списков товаров и истории цен
+cache = create_cache()
+
+# Графики истории цен: отрисовка в пуле процессов и LRU-кэш готовых изображений
+charts = ChartRenderer(
+    workers=int(os.getenv('API_CHART_WORKERS', '2')),
+    cache_size=int(os.getenv('API_CHART_CACHE_SIZE', '256')),
+)
+
+# Канал уведомлений парсеру о новых товарах: они загружаются сразу, а не в следующем проходе
+NEW_ITEMS_CHANNEL = 'new_catalog_items'
+
+
 # Обработчик события запуска приложения
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
         await init_db()  # Инициализация базы данных
         logger.info("База данных инициализирована")
-        yield  # Успешная инициализация, продолжаем выполнение приложения
     except Exception as e:
         logger.error(f"Ошибка при инициализации базы данных: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при инициализации базы данных")
 
+    # Сброс кэша, когда парсер записывает новые данные
+    listener = asyncio.create_task(listen_for_catalog_updates(cache))
+    try:
+        yield  # Успешная инициализация, продолжаем выполнение приложения
+    finally:
+        listener.cancel()
+        charts.shutdown()
+        await engine.dispose()
+
 app = FastAPI(lifespan=lifespan)
 
+# Потоковая выдача списков построчно в формате NDJSON по заголовку Accept
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = 500  # строк, забираемых из серверного курсора за раз
+
+
+def wants_ndjson(request: Request):
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+# Записи читаются через серверный курсор и отдаются по мере чтения, поэтому память
+# не зависит от размера выдачи. Сессия открывается внутри генератора: сессия из get_db
+# закрывается до того, как начнётся отправка ответа. rows - запрос выбирает столбцы, а не модель
+def stream_ndjson(query, view, rows=False):
+    async def generate():
+        try:
+            async with SessionLocal() as db:
+                result = await db.stream(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+                async for record in (result if rows else result.scalars()):
+                    yield view.model_validate(record).model_dump_json() + "\n"
+        except Exception as e:
+            logger.error(f"Ошибка при потоковой выдаче: {e}")
+
+    return StreamingResponse(generate(), media_type=NDJSON_MEDIA_TYPE)
+
+
+# Сериализация списков один раз - готовое тело ответа кладётся в кэш
+product_list_adapter = TypeAdapter(List[ProductView])
+price_history_list_adapter = TypeAdapter(List[PriceHistoryView])
+
+
+def render_json(adapter, records):
+    return adapter.dump_json(adapter.validate_python(records, from_attributes=True))
+
+
+def json_response(cached):
+    return Response(cached.body, media_type="application/json", headers=cached.headers)
+
+
+# Слабый ETag из результата дешёвого агрегирующего запроса: число записей и время последнего изменения
+def make_etag(*parts):
+    return 'W/"' + hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+def not_modified(etag):
+    return Response(status_code=304, headers={"ETag": etag})
+
 
 # Добавление нового товара на мониторинг
 @app.post("/products/", response_model=ProductView)
@@ -46,12 +136,22 @@ async def create_product(product: ProductCreate, request: Request, db: AsyncSess
     session_id = request.headers.get("X-Session-ID")
     if not session_id:
         raise HTTPException(status_code=400, detail="Session ID is required")
+    item_id = extract_product_id(product.url)
+    if item_id is None or len(product.url) > Product.url.type.length:
+        raise HTTPException(status_code=400, detail="Invalid product URL")
 
     try:
-        db_product = Product(url=product.url, user_id=session_id)
+        # Товар каталога общий для всех подписчиков, создаётся при первой подписке
+        await db.execute(upsert_catalog_items([item_id]))
+        item = await db.get(CatalogItem, item_id)
+
+        db_product = Product(url=product.url, user_id=session_id, item=item)
         db.add(db_product)
+        if item.name is None:
+            await db.execute(select(func.pg_notify(NEW_ITEMS_CHANNEL, item_id)))
         await db.commit()
         await db.refresh(db_product)
+        await cache.invalidate_user(session_id)
         logger.info(f"Товар добавлен на мониторинг пользователем {session_id}: {product.url}")
         return db_product
     except Exception as e:
@@ -59,6 +159,96 @@ async def create_product(product: ProductCreate, request: Request, db: AsyncSess
         raise HTTPException(status_code=500, detail="Ошибка при добавлении товара")
 
 
+# Пакетное добавление товаров: одна транзакция и многострочные INSERT вместо запроса на каждый товар.
+# Товары, на которые пользователь уже подписан, повторно не добавляются
+@app.post("/products/batch", response_model=List[ProductBatchResult])
+async def create_products_batch(batch: ProductBatchCreate, request: Request, db: AsyncSession = Depends(get_db)):
+    session_id = request.headers.get("X-Session-ID")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="Session ID is required")
+
+    try:
+        urls = [url.strip() for url in batch.urls]
+        max_length = Product.url.type.length
+
+        # Ссылки без корректного ID товара или слишком длинные отмечаются как invalid
+        item_ids = {url: extract_product_id(url) if len(url) <= max_length else None for url in urls}
+
+        # Каждый товар каталога добавляется один раз - по первой ссылке на него в пакете
+        valid = {}
+        for url in urls:
+            if item_ids[url] is not None:
+                valid.setdefault(item_ids[url], url)
+
+        existing = {}
+        if valid:
+            result = await db.execute(
+                select(Product.item_id, Product.id)
+                .where(Product.user_id == session_id, Product.item_id.in_(list(valid)))
+            )
+            existing = dict(result.all())
+
+        added = {}
+        new_items = {item_id: url for item_id, url in valid.items() if item_id not in existing}
+        if new_items:
+            await db.execute(upsert_catalog_items(new_items))
+            result = await db.execute(
+                insert(Product)
+                .values([{'url': url, 'user_id': session_id, 'item_id': item_id} for item_id, url in new_items.items()])
+                .returning(Product.item_id, Product.id)
+            )
+            added = dict(result.all())
+            # Пустой payload - парсер сам выберет все ещё не загруженные товары
+            await db.execute(select(func.pg_notify(NEW_ITEMS_CHANNEL, '')))
+        await db.commit()
+        await cache.invalidate_user(session_id)
+
+        results = []
+        reported = set()
+        for url in urls:
+            item_id = item_ids[url]
+            if item_id is None:
+                results.append(ProductBatchResult(url=url, status="invalid"))
+            elif item_id in added and item_id not in reported:
+                reported.add(item_id)
+                results.append(ProductBatchResult(url=url, id=added[item_id], status="added"))
+            else:
+                results.append(ProductBatchResult(url=url, id=existing.get(item_id, added.get(item_id)), status="exists"))
+
+        logger.info(f"Пользователь {session_id} добавил пакетом {len(added)} из {len(urls)} товаров")
+        return results
+    except Exception as e:
+        logger.error(f"Ошибка при пакетном добавлении товаров: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при добавлении товаров")
+
+
+# Пакетное удаление товаров одним запросом DELETE ... RETURNING
+@app.delete("/products/batch", response_model=List[ProductBatchResult])
+async def delete_products_batch(batch: ProductBatchDelete, request: Request, db: AsyncSession = Depends(get_db)):
+    session_id = request.headers.get("X-Session-ID")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="Session ID is required")
+
+    try:
+        result = await db.execute(
+            delete(Product)
+            .where(Product.id.in_(batch.ids), Product.user_id == session_id)
+            .returning(Product.id)
+        )
+        deleted = set(result.scalars().all())
+        await db.commit()
+        await cache.invalidate_user(session_id)
+
+        logger.info(f"Пользователь {session_id} удалил пакетом {len(deleted)} из {len(batch.ids)} товаров")
+        return [
+            ProductBatchResult(id=product_id, status="deleted" if product_id in deleted else "not_found")
+            for product_id in dict.fromkeys(batch.ids)
+        ]
+    except Exception as e:
+        logger.error(f"Ошибка при пакетном удалении товаров: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при удалении товаров")
+
+
 # Удаление товара
 @app.delete("/products/{product_id}")
 async def delete_product(product_id: int, request: Request, db: AsyncSession = Depends(get_db)):
@@ -71,12 +261,10 @@ async def delete_product(product_id: int, request: Request, db: AsyncSession = D
         if not db_product or db_product.user_id != session_id:
             raise HTTPException(status_code=404, detail="Product not found or does not belong to you")
 
-        # Удаляем связанные записи из таблицы price_history
-        await db.execute(
-            delete(PriceHistory).where(PriceHistory.product_id == product_id)
-        )
+        # История цен хранится по товару каталога и остаётся для других подписчиков
         await db.delete(db_product)
         await db.commit()
+        await cache.invalidate_user(session_id)
         logger.info(f"Товар с ID {product_id} удалён пользователем {session_id}")
         return {"message": "Product deleted"}
     except Exception as e:
@@ -92,25 +280,98 @@ async def get_products(request: Request, db: AsyncSession = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Session ID is required")
 
     try:
+        query = select(Product).where(Product.user_id == session_id)
+        if wants_ndjson(request):
+            logger.info(f"Пользователь {session_id} запросил список товаров в потоковом режиме")
+            return stream_ndjson(query.order_by(Product.id), ProductView)
+
+        # ETag закэшированного ответа актуален, пока кэш не сброшен, - проверка без обращения к БД
+        cache_key = "products"
+        cached = await cache.get(session_id, cache_key)
+        if cached:
+            logger.info(f"Пользователь {session_id} запросил список товаров (из кэша)")
+            if etag_matches(request, cached.headers["ETag"]):
+                return not_modified(cached.headers["ETag"])
+            return json_response(cached)
+
+        # Список меняется при добавлении и удалении подписок, при изменении данных товаров
+        # и средней цены, которая сдвигается и без изменения цены
         result = await db.execute(
-            select(Product).where(Product.user_id == session_id)
+            select(func.count(Product.id), func.max(Product.id), func.max(CatalogItem.updated_at),
+                   func.sum(CatalogItem.avg_price_30d))
+            .join(CatalogItem, Product.item_id == CatalogItem.id)
+            .where(Product.user_id == session_id)
         )
+        etag = make_etag(*result.one())
+        if etag_matches(request, etag):
+            logger.info(f"Список товаров пользователя {session_id} не изменился")
+            return not_modified(etag)
+
+        result = await db.execute(query)
         products = result.scalars().all()
+        cached = CachedResponse(render_json(product_list_adapter, products), {"ETag": etag})
+        await cache.set(session_id, cache_key, cached)
         logger.info(f"Пользователь {session_id} запросил список товаров")
-        return products
+        return json_response(cached)
     except Exception as e:
         logger.error(f"Ошибка при получении списка товаров: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при получении списка товаров")
 
 
-# Получение истории цен на товар
+# Интервал агрегации истории цен
+class Bucket(str, Enum):
+    hour = "hour"
+    day = "day"
+
+
+BUCKET_STEPS = {Bucket.hour: timedelta(hours=1), Bucket.day: timedelta(days=1)}
+
+
+# История хранится в UTC без часового пояса; границы диапазона с поясом (например, ...Z)
+# приводятся к тому же виду, иначе asyncpg отклоняет сравнение
+def as_naive_utc(value):
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+# Курсор страницы истории - позиция последней отданной записи (recorded_at, id)
+def encode_history_cursor(record):
+    value = f"{record.recorded_at.isoformat()}|{record.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_history_cursor(cursor):
+    try:
+        recorded_at, record_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(recorded_at), int(record_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# Получение истории цен на товар: диапазон from/to и постраничная выдача по курсору.
+# Курсор следующей страницы возвращается в заголовке X-Next-Cursor.
+# В потоковом режиме (Accept: application/x-ndjson) отдаётся весь диапазон без limit
 @app.get("/products/{product_id}/price-history", response_model=List[PriceHistoryView])
-async def get_price_history(request: Request, product_id: int, db: AsyncSession = Depends(get_db)):
+async def get_price_history(request: Request, product_id: int,
+                            from_: Optional[datetime] = Query(None, alias="from"), to: Optional[datetime] = None,
+                            cursor: Optional[str] = None, limit: int = Query(1000, ge=1, le=10000),
+                            db: AsyncSession = Depends(get_db)):
     session_id = request.headers.get("X-Session-ID")
     if not session_id:
         raise HTTPException(status_code=400, detail="Session ID is required")
+    from_, to = as_naive_utc(from_), as_naive_utc(to)
 
     try:
+        # В кэш попадают только ответы на товары пользователя, поэтому проверка владельца не нужна
+        cache_key = f"history:{product_id}:{from_}:{to}:{cursor}:{limit}"
+        cached = None if wants_ndjson(request) else await cache.get(session_id, cache_key)
+        if cached:
+            logger.info(f"Пользователь {session_id} запросил историю цен для товара с ID {product_id} (из кэша)")
+            if etag_matches(request, cached.headers["ETag"]):
+                return not_modified(cached.headers["ETag"])
+            return json_response(cached)
+
         result = await db.execute(
             select(Product).where(Product.id == product_id, Product.user_id == session_id)
         )
@@ -119,16 +380,287 @@ async def get_price_history(request: Request, product_id: int, db: AsyncSession
         if not product:
             raise HTTPException(status_code=404, detail="Product not found or does not belong to you")
 
+        # История только дописывается (и изредка сжимается), поэтому её версию задают
+        # число записей и время последней из них
         result = await db.execute(
-            select(PriceHistory).where(PriceHistory.product_id == product_id)
+            select(func.count(PriceHistory.id), func.max(PriceHistory.recorded_at))
+            .where(PriceHistory.item_id == product.item_id)
         )
-        history = result.scalars().all()
+        etag = make_etag(*result.one())
+        if etag_matches(request, etag):
+            logger.info(f"История цен для товара с ID {product_id} не изменилась")
+            return not_modified(etag)
+
+        # История общая для всех подписчиков товара; в ответе - ID подписки, по которой она запрошена
+        query = select(
+            PriceHistory.id, literal(product.id, Integer).label("product_id"), PriceHistory.item_id,
+            PriceHistory.price, PriceHistory.recorded_at,
+        ).where(PriceHistory.item_id == product.item_id)
+        if from_:
+            query = query.where(PriceHistory.recorded_at >= from_)
+        if to:
+            query = query.where(PriceHistory.recorded_at < to)
+        if cursor:
+            query = query.where(tuple_(PriceHistory.recorded_at, PriceHistory.id) > decode_history_cursor(cursor))
+        query = query.order_by(PriceHistory.recorded_at, PriceHistory.id)
+
+        if wants_ndjson(request):
+            logger.info(f"Пользователь {session_id} запросил историю цен для товара с ID {product_id} "
+                        f"в потоковом режиме")
+            return stream_ndjson(query, PriceHistoryView, rows=True)
 
-        if not history:
+        result = await db.execute(query.limit(limit))
+        history = result.all()
+
+        if not history and not (from_ or to or cursor):
             raise HTTPException(status_code=404, detail="No price history found for this product")
 
+        headers = {"ETag": etag}
+        if len(history) == limit:
+            headers["X-Next-Cursor"] = encode_history_cursor(history[-1])
+        cached = CachedResponse(render_json(price_history_list_adapter, history), headers)
+        await cache.set(session_id, cache_key, cached)
+
         logger.info(f"Пользователь {session_id} запросил историю цен для товара с ID {product_id}")
-        return history
+        return json_response(cached)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при получении истории цен для товара с ID {product_id}: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при получении истории цен")
+
+
+# Агрегированная история цен: минимум, максимум и последняя цена за час или день, считаются в БД.
+# Для продолжения выдачи X-Next-Cursor передаётся в параметр from
+@app.get("/products/{product_id}/price-history/buckets", response_model=List[PriceHistoryBucketView])
+async def get_price_history_buckets(request: Request, response: Response, product_id: int,
+                                    bucket: Bucket = Bucket.day,
+                                    from_: Optional[datetime] = Query(None, alias="from"),
+                                    to: Optional[datetime] = None, limit: int = Query(1000, ge=1, le=10000),
+                                    db: AsyncSession = Depends(get_db)):
+    session_id = request.headers.get("X-Session-ID")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="Session ID is required")
+    from_, to = as_naive_utc(from_), as_naive_utc(to)
+
+    try:
+        result = await db.execute(
+            select(Product).where(Product.id == product_id, Product.user_id == session_id)
+        )
+        product = result.scalars().first()
+
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found or does not belong to you")
+
+        bucket_start = func.date_trunc(bucket.value, PriceHistory.recorded_at).label("bucket_start")
+        query = (
+            select(
+                bucket_start,
+                func.min(PriceHistory.price).label("min_price"),
+                func.max(PriceHistory.price).label("max_price"),
+                array_agg(aggregate_order_by(PriceHistory.price, PriceHistory.recorded_at.desc()))[1].label("last_price"),
+                func.count().label("samples"),
+            )
+            .where(PriceHistory.item_id == product.item_id)
+            .group_by(bucket_start)
+            .order_by(bucket_start)
+            .limit(limit)
+        )
+        if from_:
+            query = query.where(PriceHistory.recorded_at >= from_)
+        if to:
+            query = query.where(PriceHistory.recorded_at < to)
+        result = await db.execute(query)
+        buckets = result.all()
+
+        # Следующая страница начинается с первой записи после последнего отданного интервала
+        if len(buckets) == limit:
+            response.headers["X-Next-Cursor"] = (buckets[-1].bucket_start + BUCKET_STEPS[bucket]).isoformat()
+
+        logger.info(f"Пользователь {session_id} запросил агрегированную историю цен для товара с ID {product_id}")
+        return buckets
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при получении агрегированной истории цен для товара с ID {product_id}: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при получении истории цен")
+
+
+# Добавление правила оповещения о снижении цены товара пользователя
+@app.post("/products/{product_id}/alerts", response_model=PriceAlertView)
+async def create_price_alert(product_id: int, alert: PriceAlertCreate, request: Request,
+                             db: AsyncSession = Depends(get_db)):
+    session_id = request.headers.get("X-Session-ID")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="Session ID is required")
+    if alert.rule != 'low' and alert.threshold is None:
+        raise HTTPException(status_code=400, detail="Threshold is required for this rule")
+    if alert.rule == 'drop' and alert.threshold >= 100:
+        raise HTTPException(status_code=400, detail="Drop threshold must be below 100 percent")
+
+    try:
+        result = await db.execute(
+            select(Product.id).where(Product.id == product_id, Product.user_id == session_id)
+        )
+        if result.scalar() is None:
+            raise HTTPException(status_code=404, detail="Product not found or does not belong to you")
+
+        # Оповещения правил из API бот не отправляет - они забираются через GET /alerts/pending
+        price_alert = PriceAlert(
+            product_id=product_id, rule=alert.rule, threshold=alert.threshold if alert.rule != 'low' else None,
+            channel='api',
+        )
+        db.add(price_alert)
+        await db.commit()
+        await db.refresh(price_alert)
+        logger.info(f"Пользователь {session_id} добавил правило оповещения {alert.rule} для товара с ID {product_id}")
+        return price_alert
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении правила оповещения: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при добавлении правила оповещения")
+
+
+# Правила оповещений для товара пользователя
+@app.get("/products/{product_id}/alerts", response_model=List[PriceAlertView])
+async def get_price_alerts(product_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    session_id = request.headers.get("X-Session-ID")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="Session ID is required")
+
+    try:
+        result = await db.execute(
+            select(PriceAlert)
+            .join(Product, Product.id == PriceAlert.product_id)
+            .where(PriceAlert.product_id == product_id, Product.user_id == session_id)
+            .order_by(PriceAlert.id)
+        )
+        return result.scalars().all()
+    except Exception as e:
+        logger.error(f"Ошибка при получении правил оповещений: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при получении правил оповещений")
+
+
+# Удаление правила оповещения
+@app.delete("/products/{product_id}/alerts/{alert_id}")
+async def delete_price_alert(product_id: int, alert_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    session_id = request.headers.get("X-Session-ID")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="Session ID is required")
+
+    try:
+        result = await db.execute(
+            delete(PriceAlert)
+            .where(
+                PriceAlert.id == alert_id, PriceAlert.product_id == product_id,
+                PriceAlert.product_id.in_(select(Product.id).where(Product.user_id == session_id)),
+            )
+            .returning(PriceAlert.id)
+        )
+        if result.scalar() is None:
+            raise HTTPException(status_code=404, detail="Alert not found or does not belong to you")
+        await db.commit()
+        logger.info(f"Пользователь {session_id} удалил правило оповещения с ID {alert_id}")
+        return {"message": "Alert deleted"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при удалении правила оповещения с ID {alert_id}: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при удалении правила оповещения")
+
+
+# Оповещения о снижении цен по правилам пользователя из API. Выданные оповещения удаляются
+# из alert_outbox, поэтому каждое возвращается один раз
+@app.get("/alerts/pending", response_model=List[AlertNotificationView])
+async def get_pending_alerts(request: Request, limit: int = Query(100, ge=1, le=1000),
+                             db: AsyncSession = Depends(get_db)):
+    session_id = request.headers.get("X-Session-ID")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="Session ID is required")
+
+    try:
+        pending = (
+            select(AlertOutbox.id)
+            .where(AlertOutbox.channel == 'api', AlertOutbox.user_id == session_id)
+            .order_by(AlertOutbox.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        result = await db.execute(
+            delete(AlertOutbox).where(AlertOutbox.id.in_(pending)).returning(AlertOutbox)
+        )
+        alerts = sorted(result.scalars().all(), key=lambda alert: alert.id)
+        await db.commit()
+        logger.info(f"Пользователь {session_id} получил оповещений о снижении цен: {len(alerts)}")
+        return alerts
+    except Exception as e:
+        logger.error(f"Ошибка при получении оповещений: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при получении оповещений")
+
+
+# Формат графика истории цен
+class ChartFormat(str, Enum):
+    png = "png"
+    svg = "svg"
+
+
+# График истории цен товара. История прореживается (NumPy) до разрешения графика и рисуется
+# в пуле процессов; готовые изображения кэшируются по товару и времени последней записи истории
+@app.get("/products/{product_id}/price-history/chart")
+async def get_price_history_chart(request: Request, product_id: int,
+                                  fmt: ChartFormat = Query(ChartFormat.png, alias="format"),
+                                  db: AsyncSession = Depends(get_db)):
+    session_id = request.headers.get("X-Session-ID")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="Session ID is required")
+
+    try:
+        result = await db.execute(
+            select(Product).where(Product.id == product_id, Product.user_id == session_id)
+        )
+        product = result.scalars().first()
+
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found or does not belong to you")
+
+        last_recorded_at = await db.scalar(
+            select(func.max(PriceHistory.recorded_at)).where(PriceHistory.item_id == product.item_id)
+        )
+        if last_recorded_at is None:
+            raise HTTPException(status_code=404, detail="No price history found for this product")
+
+        etag = make_etag(product.item_id, last_recorded_at, fmt.value)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+
+        chart_key = (product.item_id, last_recorded_at, fmt.value)
+        chart = charts.get(chart_key)
+        if chart is None:
+            result = await db.execute(
+                select(cast(func.extract('epoch', PriceHistory.recorded_at), Float), cast(PriceHistory.price, Float))
+                .where(PriceHistory.item_id == product.item_id)
+                .order_by(PriceHistory.recorded_at)
+            )
+            history = np.array(result.all(), dtype=np.float64).reshape(-1, 2)
+            chart = await charts.render(chart_key, history, product.name or f"Товар {product.item_id}", fmt.value)
+
+        logger.info(f"Пользователь {session_id} запросил график цен для товара с ID {product_id}")
+        return Response(content=chart, media_type=CHART_MEDIA_TYPES[fmt.value], headers={"ETag": etag})
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при построении графика цен для товара с ID {product_id}: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при построении графика цен")
+
+
+# Метрики кэша ответов и кэша графиков
+@app.get("/metrics/cache")
+async def get_cache_metrics():
+    return {**cache.metrics(), 'charts': charts.metrics()}
+
+
+# Метрики пула соединений с базой данных
+@app.get("/metrics/db")
+async def get_db_metrics():
+    return pool_metrics(engine)
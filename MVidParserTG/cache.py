@@ -0,0 +1,79 @@
+import asyncio
+from collections import OrderedDict
+from db import connect_listener
+import logging
+
+
+logger = logging.getLogger()
+
+# Канал, в который парсер сообщает о записи новых данных каталога
+CATALOG_UPDATES_CHANNEL = 'catalog_updates'
+
+
+# Кэш отрисованных страниц /list и /history по пользователям. Страницы живут до следующего
+# обновления цен парсером или изменения подписок пользователя; при переполнении вытесняются
+# страницы давно не обращавшихся пользователей
+class PageCache:
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()  # id пользователя -> {ключ страницы: (текст, кнопки)}
+
+    def get(self, user_id, key):
+        page = self._pages.get(user_id, {}).get(key)
+        if page is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._pages.move_to_end(user_id)
+        return page
+
+    def set(self, user_id, key, page):
+        self._pages.setdefault(user_id, {})[key] = page
+        self._pages.move_to_end(user_id)
+        while len(self._pages) > self.max_users:
+            self._pages.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        self._pages.pop(user_id, None)
+
+    def invalidate_all(self):
+        self._pages.clear()
+
+
+# Подписчики изменившихся товаров из уведомления парсера
+SUBSCRIBERS_SQL = "SELECT DISTINCT user_id FROM products WHERE item_id = ANY($1::varchar[])"
+
+
+# Сброс страниц пользователей, подписанных на изменившиеся товары; пустой payload - сброс всего кэша
+async def invalidate_items(conn, cache, payload):
+    if not payload:
+        cache.invalidate_all()
+        return
+    for row in await conn.fetch(SUBSCRIBERS_SQL, payload.split(',')):
+        cache.invalidate_user(row['user_id'])
+
+
+# Сброс кэша по уведомлениям парсера (LISTEN catalog_updates); при потере соединения - переподключение.
+# Уведомления обрабатываются по очереди: соединение asyncpg не выполняет запросы параллельно
+async def listen_for_catalog_updates(cache):
+    while True:
+        try:
+            conn = await connect_listener('mvid-bot-listener')
+            notifications = asyncio.Queue()
+            conn.add_termination_listener(lambda _: notifications.put_nowait(None))
+            await conn.add_listener(CATALOG_UPDATES_CHANNEL, lambda *args: notifications.put_nowait(args[-1]))
+            logger.info(f"Подписка на канал {CATALOG_UPDATES_CHANNEL} для сброса кэша страниц")
+            try:
+                while (payload := await notifications.get()) is not None:
+                    await invalidate_items(conn, cache, payload)
+            finally:
+                await conn.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка подписки на обновления каталога: {e}")
+        # Пока подписки нет, уведомления теряются - сбрасываем кэш целиком
+        cache.invalidate_all()
+        await asyncio.sleep(5)
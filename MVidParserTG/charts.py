@@ -0,0 +1,89 @@
+import asyncio
+import io
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+
+# Размер графика и число точек после прореживания истории (примерно по одной на пиксель)
+CHART_WIDTH = 800
+CHART_HEIGHT = 400
+CHART_DPI = 100
+CHART_POINTS = 400
+
+CHART_MEDIA_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+
+# Прореживание истории до points интервалов равной длительности: минимум, максимум и последняя цена
+# в каждом непустом интервале. history - массив (n, 2) из времени (секунды эпохи) и цены,
+# отсортированный по времени
+def downsample(history, points):
+    timestamps, prices = history[:, 0], history[:, 1]
+    if len(prices) <= points:
+        return timestamps, prices, prices, prices
+    edges = np.linspace(timestamps[0], timestamps[-1], points + 1)[:-1]
+    starts = np.unique(np.searchsorted(timestamps, edges, side='left'))
+    ends = np.append(starts[1:], len(prices)) - 1
+    return timestamps[starts], np.minimum.reduceat(prices, starts), np.maximum.reduceat(prices, starts), prices[ends]
+
+
+# Отрисовка графика в PNG или SVG; выполняется в пуле процессов
+def render_chart(history, title, fmt):
+    timestamps, low, high, last = downsample(history, CHART_POINTS)
+    dates = timestamps.astype('datetime64[s]')
+
+    figure = Figure(figsize=(CHART_WIDTH / CHART_DPI, CHART_HEIGHT / CHART_DPI), dpi=CHART_DPI)
+    axes = figure.subplots()
+    # Цена меняется скачками, поэтому график ступенчатый; полоса - разброс цены внутри интервала
+    axes.fill_between(dates, low, high, step='post', alpha=0.3, linewidth=0)
+    axes.step(dates, last, where='post', linewidth=1.5)
+    axes.set_title(title)
+    axes.set_ylabel("Цена, ₽")
+    axes.grid(alpha=0.3)
+    figure.autofmt_xdate()
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+# Графики рисуются в пуле процессов, не блокируя цикл событий, и хранятся в LRU-кэше.
+# Ключ включает время последней записи истории, поэтому новая цена даёт новый график
+class ChartRenderer:
+    def __init__(self, workers, cache_size):
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        self._charts = OrderedDict()
+
+    def get(self, key):
+        chart = self._charts.get(key)
+        if chart is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._charts.move_to_end(key)
+        return chart
+
+    async def render(self, key, history, title, fmt):
+        chart = await asyncio.get_running_loop().run_in_executor(self._pool, render_chart, history, title, fmt)
+        self._charts[key] = chart
+        self._charts.move_to_end(key)
+        while len(self._charts) > self.cache_size:
+            self._charts.popitem(last=False)
+        return chart
+
+    def metrics(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests else None,
+            'size': len(self._charts),
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(cancel_futures=True)
@@ -0,0 +1,103 @@
+import os
+from collections import Counter
+from uuid import uuid4
+import asyncpg
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+load_dotenv()
+
+
+def env_flag(name, default):
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
+# Параметры пула соединений; одинаковы для парсера, API и бота и задаются в окружении каждого сервиса
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))  # постоянных соединений, 0 - без пула (соединение на сессию)
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))  # временных соединений сверх пула при всплесках нагрузки
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))  # секунд ожидания свободного соединения
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # секунд жизни соединения, -1 - без ограничения
+DB_POOL_PRE_PING = env_flag('DB_POOL_PRE_PING', 'true')  # проверка соединения перед выдачей из пула
+# Кэши подготовленных запросов на соединение: собственный кэш asyncpg и кэш диалекта SQLAlchemy
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))
+DB_PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv('DB_PREPARED_STATEMENT_CACHE_SIZE', '100'))
+# Подключение через PgBouncer в режиме pool_mode=transaction: серверное соединение может смениться
+# между транзакциями, поэтому кэши подготовленных запросов отключаются, а имена запросов уникальны
+DB_PGBOUNCER = env_flag('DB_PGBOUNCER', 'false')
+# LISTEN через PgBouncer в режиме транзакций не работает - подписки подключаются к PostgreSQL напрямую
+DB_LISTEN_HOST = os.getenv('DB_LISTEN_HOST') or os.getenv('DB_HOST')
+DB_LISTEN_PORT = os.getenv('DB_LISTEN_PORT') or os.getenv('DB_PORT')
+
+# Строка подключения к базе данных PostgreSQL
+database_url = f"postgresql+asyncpg://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+
+# Ключ блокировки pg_advisory_xact_lock на создание таблиц и миграции при запуске: экземпляры
+# парсера, API и бота стартуют одновременно, а шаги миграций не рассчитаны на параллельный запуск
+SCHEMA_LOCK_ID = 5_170_001
+
+# Счётчики событий пула: открытые соединения, выдачи из пула и соединения, признанные негодными
+pool_events = Counter()
+
+
+# Создание асинхронного Engine с настройками пула из окружения. application_name подписывает
+# соединения сервиса в pg_stat_activity
+def create_db_engine(application_name):
+    connect_args = {
+        'server_settings': {'application_name': application_name},
+        'statement_cache_size': 0 if DB_PGBOUNCER else DB_STATEMENT_CACHE_SIZE,
+        'prepared_statement_cache_size': 0 if DB_PGBOUNCER else DB_PREPARED_STATEMENT_CACHE_SIZE,
+    }
+    if DB_PGBOUNCER:
+        connect_args['prepared_statement_name_func'] = lambda: f"__asyncpg_{uuid4()}__"
+
+    if DB_POOL_SIZE > 0:
+        pool_args = {
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'pool_recycle': DB_POOL_RECYCLE,
+        }
+    else:
+        pool_args = {'poolclass': NullPool}
+
+    engine = create_async_engine(database_url, pool_pre_ping=DB_POOL_PRE_PING, connect_args=connect_args, **pool_args)
+    event.listen(engine.sync_engine, 'connect', lambda *_: pool_events.update(['connects']))
+    event.listen(engine.sync_engine, 'checkout', lambda *_: pool_events.update(['checkouts']))
+    event.listen(engine.sync_engine, 'invalidate', lambda *_: pool_events.update(['invalidations']))
+    return engine
+
+
+def create_session_factory(engine, **options):
+    return sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False, **options)
+
+
+# Состояние пула: размер, свободные и занятые соединения, соединения сверх пула и счётчики событий
+def pool_metrics(engine):
+    pool = engine.pool
+    metrics = {
+        'pool': type(pool).__name__,
+        'pgbouncer': DB_PGBOUNCER,
+        'connects': pool_events['connects'],
+        'checkouts': pool_events['checkouts'],
+        'invalidations': pool_events['invalidations'],
+    }
+    if not isinstance(pool, NullPool):
+        metrics.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    return metrics
+
+
+# Отдельное соединение asyncpg для LISTEN, минуя пул SQLAlchemy
+def connect_listener(application_name):
+    return asyncpg.connect(
+        user=os.getenv('DB_USER'), password=os.getenv('DB_PASSWORD'),
+        host=DB_LISTEN_HOST, port=DB_LISTEN_PORT, database=os.getenv('DB_NAME'),
+        server_settings={'application_name': application_name},
+    )
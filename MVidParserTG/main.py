@@ -1,7 +1,17 @@
 import asyncio
-from sqlalchemy import delete
-from telethon import TelegramClient, events
-from models import Product, get_db, PriceHistory, init_db
+import io
+from collections import defaultdict
+from datetime import datetime, time, timedelta, date
+from decimal import Decimal, InvalidOperation
+import numpy as np
+from sqlalchemy import Float, cast, delete, func
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert
+from telethon import Button, TelegramClient, errors, events
+from cache import PageCache, listen_for_catalog_updates
+from charts import ChartRenderer
+from db import pool_metrics
+from models import (Product, get_db, PriceHistory, init_db, extract_product_id, upsert_catalog_items, CatalogItem,
+                    PriceAlert, AlertOutbox, engine)
 from sqlalchemy.future import select
 import os
 from dotenv import load_dotenv
@@ -32,6 +42,89 @@ bot_token = os.getenv('BOT_TOKEN')
 # Инициализация клиента
 client = TelegramClient('bot_session', api_id, api_hash).start(bot_token=bot_token)
 
+# Канал уведомлений парсеру о новых товарах: они загружаются сразу, а не в следующем проходе
+NEW_ITEMS_CHANNEL = 'new_catalog_items'
+
+# Постраничный вывод /list и /history с кнопками перехода
+LIST_PAGE_SIZE = int(os.getenv('BOT_LIST_PAGE_SIZE', '5'))  # товаров на странице
+LIST_DESCRIPTION_LENGTH = 300  # символов описания товара в списке
+HISTORY_PAGE_DAYS = int(os.getenv('BOT_HISTORY_PAGE_DAYS', '30'))  # дней истории на странице
+MAX_MESSAGE_LENGTH = 4000
+
+# Отправка оповещений о снижении цен из alert_outbox
+ALERTS_POLL_INTERVAL = float(os.getenv('BOT_ALERTS_POLL_INTERVAL', '2'))  # секунд между проверками
+ALERTS_BATCH_SIZE = int(os.getenv('BOT_ALERTS_BATCH_SIZE', '100'))  # оповещений за одну выборку
+ALERTS_SEND_RATE = float(os.getenv('BOT_ALERTS_SEND_RATE', '20'))  # сообщений в секунду (лимит Telegram - около 30)
+
+METRICS_INTERVAL = float(os.getenv('BOT_METRICS_INTERVAL', '60'))  # секунд между записями метрик в лог
+
+# Отрисованные страницы хранятся до следующего обновления цен
+page_cache = PageCache(int(os.getenv('BOT_PAGE_CACHE_MAX_USERS', '10000')))
+
+# Графики истории цен: отрисовка в пуле процессов и LRU-кэш готовых изображений
+charts = ChartRenderer(
+    workers=int(os.getenv('BOT_CHART_WORKERS', '2')),
+    cache_size=int(os.getenv('BOT_CHART_CACHE_SIZE', '256')),
+)
+
+
+# Отправка строк сообщениями не длиннее лимита Telegram; send - функция отправки одного сообщения
+async def send_in_chunks(send, lines, max_message_length=4000):
+    message_chunk = ""
+    for line in lines:
+        if message_chunk and len(message_chunk) + len(line) + 1 > max_message_length:
+            await send(message_chunk)
+            message_chunk = ""
+        message_chunk += line + "\n"
+    if message_chunk:
+        await send(message_chunk)
+
+
+# Отправка строк ответа сообщениями не длиннее лимита Telegram
+async def reply_in_chunks(event, lines):
+    await send_in_chunks(event.reply, lines)
+
+
+# Добавление нескольких товаров одной транзакцией с многострочными INSERT.
+# Возвращает ссылки, разделённые на добавленные и уже отслеживаемые пользователем
+async def add_products(db, user_id, urls):
+    # Каждый товар каталога добавляется один раз - по первой ссылке на него
+    new_items = {}
+    for url in urls:
+        new_items.setdefault(extract_product_id(url), url)
+
+    result = await db.execute(
+        select(Product.item_id).where(Product.user_id == user_id, Product.item_id.in_(list(new_items)))
+    )
+    for item_id in result.scalars().all():
+        new_items.pop(item_id, None)
+
+    if new_items:
+        # Товар каталога общий для всех подписчиков, создаётся при первой подписке
+        await db.execute(upsert_catalog_items(new_items))
+        await db.execute(
+            insert(Product).values([{'url': url, 'user_id': user_id, 'item_id': item_id}
+                                    for item_id, url in new_items.items()])
+        )
+        # Пустой payload - парсер сам выберет все ещё не загруженные товары
+        payload = next(iter(new_items)) if len(new_items) == 1 else ''
+        await db.execute(select(func.pg_notify(NEW_ITEMS_CHANNEL, payload)))
+    await db.commit()
+
+    added = set(new_items.values())
+    return [url for url in urls if url in added], [url for url in urls if url not in added]
+
+
+# Удаление нескольких товаров пользователя одним запросом DELETE ... RETURNING
+async def remove_products(db, user_id, product_ids):
+    # История цен хранится по товару каталога и остаётся для других подписчиков
+    result = await db.execute(
+        delete(Product).where(Product.id.in_(product_ids), Product.user_id == user_id).returning(Product.id)
+    )
+    deleted = set(result.scalars().all())
+    await db.commit()
+    return deleted
+
 
 @client.on(events.NewMessage(pattern='/add'))
 async def add_product(event):
@@ -40,21 +133,31 @@ async def add_product(event):
     parts = message_text.split()
 
     if len(parts) < 2:
-        await event.reply("Использование: /add <ссылка на товар>")
+        await event.reply("Использование: /add <ссылка на товар> [<ссылка на товар> ...]")
         return
 
-    product_url = parts[1]
+    product_urls = list(dict.fromkeys(parts[1:]))
+    invalid_urls = [
+        url for url in product_urls if len(url) > Product.url.type.length or extract_product_id(url) is None
+    ]
+    product_urls = [url for url in product_urls if url not in invalid_urls]
 
     try:
-        async for db in get_db():
-            db_product = Product(url=product_url, user_id=user_id)
-            db.add(db_product)
-            await db.commit()
-            await db.refresh(db_product)
-            await event.reply(f"Товар добавлен на мониторинг: {product_url}")
-            logger.info(f"Товар добавлен: {product_url} пользователем {user_id}")
+        added, existing = [], []
+        if product_urls:
+            async for db in get_db():
+                added, existing = await add_products(db, user_id, product_urls)
+            page_cache.invalidate_user(user_id)
+
+        await reply_in_chunks(
+            event,
+            [f"Товар добавлен на мониторинг: {url}" for url in added]
+            + [f"Товар уже на мониторинге: {url}" for url in existing]
+            + [f"Некорректная ссылка на товар: {url}" for url in invalid_urls]
+        )
+        logger.info(f"Пользователь {user_id} добавил товаров: {len(added)} из {len(parts) - 1}")
     except Exception as e:
-        logger.error(f"Ошибка при добавлении товара: {e}")
+        logger.error(f"Ошибка при добавлении товаров: {e}")
         await event.reply("Произошла ошибка при добавлении товара.")
 
 
@@ -65,67 +168,176 @@ async def remove_product(event):
     parts = message_text.split()
 
     if len(parts) < 2:
-        await event.reply("Использование: /remove <ID товара>")
+        await event.reply("Использование: /remove <ID товара> [<ID товара> ...]")
         return
 
-    product_id = int(parts[1])
+    product_ids = list(dict.fromkeys(int(part) for part in parts[1:] if part.isdigit()))
+    invalid_ids = [part for part in parts[1:] if not part.isdigit()]
 
     try:
-        async for db in get_db():
-            db_product = await db.get(Product, product_id)
-            if not db_product or db_product.user_id != user_id:
-                await event.reply(f"Товар с ID {product_id} не найден.")
-                return
-
-            # Удаляем связанные записи из таблицы price_history
-            await db.execute(
-                delete(PriceHistory).where(PriceHistory.product_id == product_id)
-            )
-
-            await db.delete(db_product)
-            await db.commit()
-            await event.reply(f"Товар с ID {product_id} удалён.")
-            logger.info(f"Товар с ID {product_id} удалён пользователем {user_id}")
+        deleted = set()
+        if product_ids:
+            async for db in get_db():
+                deleted = await remove_products(db, user_id, product_ids)
+            page_cache.invalidate_user(user_id)
+
+        await reply_in_chunks(
+            event,
+            [f"Товар с ID {product_id} удалён." if product_id in deleted else f"Товар с ID {product_id} не найден."
+             for product_id in product_ids]
+            + [f"Некорректный ID товара: {part}" for part in invalid_ids]
+        )
+        logger.info(f"Пользователь {user_id} удалил товаров: {len(deleted)} из {len(parts) - 1}")
     except Exception as e:
-        logger.error(f"Ошибка при удалении товара: {e}")
+        logger.error(f"Ошибка при удалении товаров: {e}")
         await event.reply("Произошла ошибка при удалении товара.")
 
 
+# Страница из кэша или, если её там нет, отрисованная render(db)
+async def cached_page(user_id, key, render):
+    page = page_cache.get(user_id, key)
+    if page is None:
+        async for db in get_db():
+            page = await render(db)
+        page_cache.set(user_id, key, page)
+    return page
+
+
+def short_description(description):
+    if description is None or len(description) <= LIST_DESCRIPTION_LENGTH:
+        return description
+    return description[:LIST_DESCRIPTION_LENGTH].rstrip() + "…"
+
+
+# Изменение цены относительно предыдущей
+def price_trend(product):
+    if product.previous_price is None or product.price is None or product.previous_price == product.price:
+        return ""
+    arrow = "↓" if product.price < product.previous_price else "↑"
+    return f" {arrow} (было {product.previous_price})"
+
+
+# Статистика цены товара из каталога, без чтения истории
+def price_statistics(product):
+    if product.min_price is None:
+        return ""
+    changed_at = f"{product.price_changed_at:%d.%m.%Y %H:%M}" if product.price_changed_at else "-"
+    return (f"Мин / макс: {product.min_price} / {product.max_price}, средняя за 30 дней: {product.avg_price_30d}\n"
+            f"Цена изменилась: {changed_at}\n")
+
+
+# Страница списка товаров: выборка по ключу (id после/до cursor), по LIST_PAGE_SIZE товаров
+async def render_products_page(db, user_id, direction='next', cursor=None):
+    query = select(Product).where(Product.user_id == user_id)
+    if direction == 'prev':
+        query = query.where(Product.id < cursor).order_by(Product.id.desc())
+    else:
+        if cursor is not None:
+            query = query.where(Product.id > cursor)
+        query = query.order_by(Product.id)
+    result = await db.execute(query.limit(LIST_PAGE_SIZE + 1))
+    products = list(result.scalars().all())
+
+    # Лишний товар показывает, есть ли следующая страница в направлении выборки
+    has_more = len(products) > LIST_PAGE_SIZE
+    products = products[:LIST_PAGE_SIZE]
+    if direction == 'prev':
+        products.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor is not None, has_more
+
+    if not products:
+        return "У вас нет товаров на мониторинге.", None
+
+    text = "Товары на мониторинге:\n" + "".join(
+        f"ID: {product.id}\nНазвание: {product.name}\nОписание: {short_description(product.description)}\n"
+        f"Ссылка: {product.url}\nЦена: {product.price}{price_trend(product)}\nРейтинг: {product.rating}\n"
+        f"{price_statistics(product)}\n"
+        for product in products
+    )
+    buttons = []
+    if has_prev:
+        buttons.append(Button.inline("◀ Назад", f"list:prev:{products[0].id}"))
+    if has_next:
+        buttons.append(Button.inline("Вперёд ▶", f"list:next:{products[-1].id}"))
+    return text[:MAX_MESSAGE_LENGTH], buttons or None
+
+
+# Страница истории цен по дням (минимальная, максимальная и последняя цена за день) -
+# HISTORY_PAGE_DAYS календарных дней, заканчивающихся днём until или начинающихся днём since.
+# Соседние страницы начинаются с ближайших записей за пределами страницы, поэтому дни без записей
+# не дают пустых страниц
+async def render_history_page(db, user_id, product_id, anchor=None, day=None):
+    result = await db.execute(select(Product).where(Product.id == product_id, Product.user_id == user_id))
+    product = result.scalars().first()
+    if not product:
+        return f"Товар с ID {product_id} не найден.", None
+
+    item_history = PriceHistory.item_id == product.item_id
+    if day is None:
+        last_recorded_at = await db.scalar(select(func.max(PriceHistory.recorded_at)).where(item_history))
+        if last_recorded_at is None:
+            return f"История цен для товара с ID {product_id} не найдена.", None
+        day = last_recorded_at.date()
+    until = day + timedelta(days=HISTORY_PAGE_DAYS - 1) if anchor == 'since' else day
+    start = datetime.combine(until - timedelta(days=HISTORY_PAGE_DAYS - 1), time.min)
+    end = datetime.combine(until + timedelta(days=1), time.min)
+
+    recorded_day = func.date_trunc('day', PriceHistory.recorded_at).label('day')
+    result = await db.execute(
+        select(
+            recorded_day,
+            func.min(PriceHistory.price).label('min_price'),
+            func.max(PriceHistory.price).label('max_price'),
+            func.array_agg(aggregate_order_by(PriceHistory.price, PriceHistory.recorded_at.desc()))[1].label('last_price'),
+        )
+        .where(item_history, PriceHistory.recorded_at >= start, PriceHistory.recorded_at < end)
+        .group_by(recorded_day)
+        .order_by(recorded_day.desc())
+    )
+    days = result.all()
+    older = await db.scalar(select(func.max(PriceHistory.recorded_at)).where(item_history, PriceHistory.recorded_at < start))
+    newer = await db.scalar(select(func.min(PriceHistory.recorded_at)).where(item_history, PriceHistory.recorded_at >= end))
+
+    text = f"История цен товара с ID {product_id} по дням (мин / макс / последняя):\n" + "".join(
+        f"{row.day:%d.%m.%Y}: {row.min_price} / {row.max_price} / {row.last_price}\n" for row in days
+    )
+    buttons = []
+    if older is not None:
+        buttons.append(Button.inline("◀ Раньше", f"history:{product_id}:until:{older.date().isoformat()}"))
+    if newer is not None:
+        buttons.append(Button.inline("Позже ▶", f"history:{product_id}:since:{newer.date().isoformat()}"))
+    return text[:MAX_MESSAGE_LENGTH], buttons or None
+
+
 @client.on(events.NewMessage(pattern='/list'))
 async def list_products(event):
     user_id = str(event.sender_id)
 
     try:
-        async for db in get_db():
-            result = await db.execute(select(Product).where(Product.user_id == user_id))
-            products = result.scalars().all()
-
-            if not products:
-                await event.reply("У вас нет товаров на мониторинге.")
-                return
-
-            # Устанавливаем лимит на длину одного сообщения (например, 4096 символов)
-            max_message_length = 4000
-            message_chunk = "Товары на мониторинге:\n"
-
-            for product in products:
-                product_info = (f"ID: {product.id}\nНазвание: {product.name}\nОписание: {product.description}\n"
-                                f"Ссылка: {product.url}\nЦена: {product.price}\nРейтинг: {product.rating}\n\n")
+        text, buttons = await cached_page(user_id, ('list',), lambda db: render_products_page(db, user_id))
+        await event.reply(text, buttons=buttons)
+        logger.info(f"Пользователь {user_id} запросил список товаров.")
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка товаров: {e}")
+        await event.reply("Произошла ошибка при получении списка товаров.")
 
-                # Если добавление информации о продукте превышает лимит, отправляем сообщение
-                if len(message_chunk) + len(product_info) > max_message_length:
-                    await event.reply(message_chunk)
-                    message_chunk = "" # Очищаем сообщение для следующего блока
 
-                message_chunk += product_info
+@client.on(events.CallbackQuery(pattern=b'list:'))
+async def list_products_page(event):
+    user_id = str(event.sender_id)
+    _, direction, cursor = event.data.decode().split(':')
 
-            # Отправляем оставшуюся часть сообщения
-            if message_chunk:
-                await event.reply(message_chunk)
-            logger.info(f"Пользователь {user_id} запросил список товаров.")
+    try:
+        text, buttons = await cached_page(
+            user_id, ('list', direction, int(cursor)),
+            lambda db: render_products_page(db, user_id, direction, int(cursor))
+        )
+        await event.edit(text, buttons=buttons)
     except Exception as e:
         logger.error(f"Ошибка при получении списка товаров: {e}")
-        await event.reply("Произошла ошибка при получении списка товаров.")
+        await event.answer("Произошла ошибка при получении списка товаров.", alert=True)
 
 
 @client.on(events.NewMessage(pattern='/history'))
@@ -134,12 +346,52 @@ async def get_price_history(event):
     message_text = event.message.message
     parts = message_text.split()
 
-    if len(parts) < 2:
+    if len(parts) < 2 or not parts[1].isdigit():
         await event.reply("Использование: /history <ID товара>")
         return
 
     product_id = int(parts[1])
 
+    try:
+        text, buttons = await cached_page(
+            user_id, ('history', product_id), lambda db: render_history_page(db, user_id, product_id)
+        )
+        await event.reply(text, buttons=buttons)
+        logger.info(f"Пользователь {user_id} запросил историю цен для товара с ID {product_id}.")
+    except Exception as e:
+        logger.error(f"Ошибка при получении истории цен: {e}")
+        await event.reply("Произошла ошибка при получении истории цен.")
+
+
+@client.on(events.CallbackQuery(pattern=b'history:'))
+async def price_history_page(event):
+    user_id = str(event.sender_id)
+    _, product_id, anchor, day = event.data.decode().split(':')
+
+    try:
+        text, buttons = await cached_page(
+            user_id, ('history', int(product_id), anchor, day),
+            lambda db: render_history_page(db, user_id, int(product_id), anchor, date.fromisoformat(day))
+        )
+        await event.edit(text, buttons=buttons)
+    except Exception as e:
+        logger.error(f"Ошибка при получении истории цен: {e}")
+        await event.answer("Произошла ошибка при получении истории цен.", alert=True)
+
+
+# График истории цен товара в PNG; кэшируется по товару и времени последней записи истории
+@client.on(events.NewMessage(pattern='/chart'))
+async def get_price_chart(event):
+    user_id = str(event.sender_id)
+    message_text = event.message.message
+    parts = message_text.split()
+
+    if len(parts) < 2 or not parts[1].isdigit():
+        await event.reply("Использование: /chart <ID товара>")
+        return
+
+    product_id = int(parts[1])
+
     try:
         async for db in get_db():
             result = await db.execute(
@@ -151,34 +403,226 @@ async def get_price_history(event):
                 await event.reply(f"Товар с ID {product_id} не найден.")
                 return
 
-            result = await db.execute(select(PriceHistory).where(PriceHistory.product_id == product_id))
-            history = result.scalars().all()
-
-            if not history:
+            last_recorded_at = await db.scalar(
+                select(func.max(PriceHistory.recorded_at)).where(PriceHistory.item_id == product.item_id)
+            )
+            if last_recorded_at is None:
                 await event.reply(f"История цен для товара с ID {product_id} не найдена.")
                 return
 
-            # Устанавливаем лимит на длину одного сообщения (например, 4096 символов)
-            max_message_length = 4000
-            message_chunk = ""
+            chart_key = (product.item_id, last_recorded_at, 'png')
+            chart = charts.get(chart_key)
+            if chart is None:
+                result = await db.execute(
+                    select(cast(func.extract('epoch', PriceHistory.recorded_at), Float), cast(PriceHistory.price, Float))
+                    .where(PriceHistory.item_id == product.item_id)
+                    .order_by(PriceHistory.recorded_at)
+                )
+                history = np.array(result.all(), dtype=np.float64).reshape(-1, 2)
+                chart = await charts.render(chart_key, history, product.name or f"Товар {product.item_id}", 'png')
+
+        photo = io.BytesIO(chart)
+        photo.name = f"chart-{product_id}.png"
+        await event.reply(f"График цен товара с ID {product_id}", file=photo)
+        logger.info(f"Пользователь {user_id} запросил график цен для товара с ID {product_id}.")
+    except Exception as e:
+        logger.error(f"Ошибка при построении графика цен: {e}")
+        await event.reply("Произошла ошибка при построении графика цен.")
+
+
+# Описание правила оповещения для пользователя
+def describe_alert_rule(rule, threshold):
+    if rule == 'target':
+        return f"цена не выше {threshold}"
+    if rule == 'drop':
+        return f"снижение цены не меньше чем на {threshold}%"
+    return "новый исторический минимум цены"
 
-            for hstr in history:
-                history_info = f"product_id: {hstr.product_id}\nЦена: {hstr.price}\nДата: {hstr.recorded_at}\n\n"
 
-                # Если добавление информации о продукте превышает лимит, отправляем сообщение
-                if len(message_chunk) + len(history_info) > max_message_length:
-                    await event.reply(message_chunk)
-                    message_chunk = ""
+# Строка оповещения о сработавшем правиле
+def format_alert(alert, name):
+    if alert.rule == 'target':
+        reason = "цена достигла целевой"
+    elif alert.rule == 'drop':
+        reason = f"цена снизилась на {(alert.old_price - alert.new_price) * 100 / alert.old_price:.1f}%"
+    else:
+        reason = "новый исторический минимум"
+    return f"ID {alert.product_id} {name or ''}: {alert.old_price} → {alert.new_price} ({reason})"
 
-                message_chunk += history_info
 
-            # Отправляем оставшуюся часть сообщения
-            if message_chunk:
-                await event.reply(message_chunk)
-            logger.info(f"Пользователь {user_id} запросил историю цен для товара с ID {product_id}.")
+@client.on(events.NewMessage(pattern=r'/alert\b'))
+async def add_price_alert(event):
+    user_id = str(event.sender_id)
+    message_text = event.message.message
+    parts = message_text.split()
+
+    usage = ("Использование: /alert <ID товара> <цена> - цена опустилась до заданной\n"
+             "/alert <ID товара> <N>% - цена снизилась не меньше чем на N%\n"
+             "/alert <ID товара> min - новый исторический минимум")
+    if len(parts) < 3 or not parts[1].isdigit():
+        await event.reply(usage)
+        return
+
+    product_id = int(parts[1])
+    spec = parts[2].lower()
+    try:
+        if spec == 'min':
+            rule, threshold = 'low', None
+        elif spec.endswith('%'):
+            rule, threshold = 'drop', Decimal(spec[:-1])
+        else:
+            rule, threshold = 'target', Decimal(spec)
+        valid = threshold is None or (0 < threshold and (rule != 'drop' or threshold < 100))
+    except InvalidOperation:
+        valid = False
+    if not valid:
+        await event.reply(usage)
+        return
+
+    try:
+        async for db in get_db():
+            result = await db.execute(
+                select(Product.id).where(Product.id == product_id, Product.user_id == user_id)
+            )
+            if result.scalar() is None:
+                await event.reply(f"Товар с ID {product_id} не найден.")
+                return
+
+            price_alert = PriceAlert(product_id=product_id, rule=rule, threshold=threshold, channel='telegram')
+            db.add(price_alert)
+            await db.commit()
+            await event.reply(f"Правило {price_alert.id} добавлено: товар с ID {product_id}, "
+                              f"{describe_alert_rule(rule, threshold)}.")
+            logger.info(f"Пользователь {user_id} добавил правило оповещения {rule} для товара с ID {product_id}.")
     except Exception as e:
-        logger.error(f"Ошибка при получении истории цен: {e}")
-        await event.reply("Произошла ошибка при получении истории цен.")
+        logger.error(f"Ошибка при добавлении правила оповещения: {e}")
+        await event.reply("Произошла ошибка при добавлении правила оповещения.")
+
+
+@client.on(events.NewMessage(pattern='/alerts'))
+async def list_price_alerts(event):
+    user_id = str(event.sender_id)
+
+    try:
+        async for db in get_db():
+            result = await db.execute(
+                select(PriceAlert)
+                .join(Product, Product.id == PriceAlert.product_id)
+                .where(Product.user_id == user_id)
+                .order_by(PriceAlert.id)
+            )
+            alerts = result.scalars().all()
+
+        if not alerts:
+            await event.reply("У вас нет правил оповещений.")
+            return
+        await reply_in_chunks(
+            event,
+            ["Правила оповещений:"] + [
+                f"{alert.id}: товар с ID {alert.product_id}, {describe_alert_rule(alert.rule, alert.threshold)}"
+                for alert in alerts
+            ]
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при получении правил оповещений: {e}")
+        await event.reply("Произошла ошибка при получении правил оповещений.")
+
+
+@client.on(events.NewMessage(pattern='/unalert'))
+async def remove_price_alert(event):
+    user_id = str(event.sender_id)
+    message_text = event.message.message
+    parts = message_text.split()
+
+    if len(parts) < 2 or not parts[1].isdigit():
+        await event.reply("Использование: /unalert <ID правила>")
+        return
+
+    alert_id = int(parts[1])
+
+    try:
+        async for db in get_db():
+            result = await db.execute(
+                delete(PriceAlert)
+                .where(PriceAlert.id == alert_id,
+                       PriceAlert.product_id.in_(select(Product.id).where(Product.user_id == user_id)))
+                .returning(PriceAlert.id)
+            )
+            deleted = result.scalar()
+            await db.commit()
+
+        await event.reply(f"Правило {alert_id} удалено." if deleted else f"Правило {alert_id} не найдено.")
+    except Exception as e:
+        logger.error(f"Ошибка при удалении правила оповещения: {e}")
+        await event.reply("Произошла ошибка при удалении правила оповещения.")
+
+
+# Отправка накопленных оповещений правил бота: выборка из alert_outbox (FOR UPDATE SKIP LOCKED - несколько
+# экземпляров бота не отправят оповещение дважды), одно сообщение на пользователя, не чаще
+# ALERTS_SEND_RATE сообщений в секунду. Отправленные оповещения удаляются в той же транзакции.
+# Возвращает число выбранных оповещений
+async def drain_alert_outbox():
+    flood_wait = 0
+    async for db in get_db():
+        result = await db.execute(
+            select(AlertOutbox, CatalogItem.name)
+            .join(Product, Product.id == AlertOutbox.product_id)
+            .join(CatalogItem, CatalogItem.id == Product.item_id)
+            .where(AlertOutbox.channel == 'telegram')
+            .order_by(AlertOutbox.id)
+            .limit(ALERTS_BATCH_SIZE)
+            .with_for_update(of=AlertOutbox, skip_locked=True)
+        )
+        rows = result.all()
+        alerts_by_user = defaultdict(list)
+        for alert, name in rows:
+            alerts_by_user[alert.user_id].append((alert, name))
+
+        delivered = []
+        for user_id, alerts in alerts_by_user.items():
+            try:
+                await send_in_chunks(
+                    lambda message: client.send_message(int(user_id), message),
+                    ["Цена снизилась:"] + [format_alert(alert, name) for alert, name in alerts]
+                )
+            except errors.FloodWaitError as e:
+                # Неотправленные оповещения останутся в очереди до следующей попытки
+                logger.warning(f"Telegram ограничил отправку сообщений на {e.seconds} с")
+                flood_wait = e.seconds
+                break
+            except Exception as e:
+                # Например, пользователь заблокировал бота - повторная отправка не поможет
+                logger.error(f"Не удалось отправить оповещения пользователю {user_id}: {e}")
+            delivered += [alert.id for alert, _ in alerts]
+            await asyncio.sleep(1 / ALERTS_SEND_RATE)
+
+        if delivered:
+            await db.execute(delete(AlertOutbox).where(AlertOutbox.id.in_(delivered)))
+        await db.commit()
+        if delivered:
+            logger.info(f"Отправлено оповещений о снижении цен: {len(delivered)}")
+
+    await asyncio.sleep(flood_wait)
+    return len(rows)
+
+
+async def send_price_alerts():
+    while True:
+        try:
+            selected = await drain_alert_outbox()
+        except Exception as e:
+            logger.error(f"Ошибка при отправке оповещений: {e}")
+            selected = 0
+        if selected < ALERTS_BATCH_SIZE:
+            await asyncio.sleep(ALERTS_POLL_INTERVAL)
+
+
+# Периодическая запись метрик пула соединений с базой и кэша страниц в лог
+async def report_metrics():
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        logger.info(f"Пул соединений с базой: {pool_metrics(engine)}")
+        logger.info(f"Кэш страниц: попаданий - {page_cache.hits}, промахов - {page_cache.misses}")
 
 
 async def main():
@@ -186,12 +630,24 @@ async def main():
     await init_db()
     logger.info("База данных инициализирована")
 
-    # Запускаем бота
-    await client.start(bot_token=bot_token)
-    logger.info("Бот запущен!")
+    # Сброс кэша страниц, когда парсер записывает новые данные
+    listener = asyncio.create_task(listen_for_catalog_updates(page_cache))
+    alerts_sender = asyncio.create_task(send_price_alerts())
+    reporter = asyncio.create_task(report_metrics())
 
-    # Запускаем бота в event loop до отключения
-    await client.run_until_disconnected()
+    try:
+        # Запускаем бота
+        await client.start(bot_token=bot_token)
+        logger.info("Бот запущен!")
+
+        # Запускаем бота в event loop до отключения
+        await client.run_until_disconnected()
+    finally:
+        listener.cancel()
+        alerts_sender.cancel()
+        reporter.cancel()
+        charts.shutdown()
+        await engine.dispose()
 
 
 if __name__ == '__main__':
@@ -1,55 +1,196 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+import re
+from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Text, Numeric, ForeignKey, DECIMAL, DateTime
+from sqlalchemy import Column, Integer, String, Text, Numeric, ForeignKey, DECIMAL, DateTime, Date, Index, func, text
+from sqlalchemy.dialects.postgresql import insert
 from datetime import datetime
-from dotenv import load_dotenv
-import os
+from urllib.parse import urlsplit
+from db import SCHEMA_LOCK_ID, create_db_engine, create_session_factory
 
-load_dotenv()
-
-# Асинхронная строка подключения к базе данных PostgreSQL
-database_url = f"postgresql+asyncpg://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
-
-# Создание асинхронного объекта Engine для подключения
-engine = create_async_engine(database_url)
+# Подключение к базе данных PostgreSQL с настройками пула из окружения (db.py)
+engine = create_db_engine('mvid-bot')
 
 # Создание асинхронной сессии
-SessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+SessionLocal = create_session_factory(engine)
 
 # Базовый класс для моделей
 Base = declarative_base()
 
 
-# Модель товара
-class Product(Base):
-    __tablename__ = "products"
+# Модель товара каталога М.Видео, общая для всех подписчиков
+class CatalogItem(Base):
+    __tablename__ = "catalog_items"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(String(64), primary_key=True)  # id товара М.Видео из ссылки
     name = Column(String(255), nullable=True)
     description = Column(Text, nullable=True)
     rating = Column(Numeric(2, 1), nullable=True)
-    url = Column(String(255), nullable=False)
     price = Column(DECIMAL(10, 2), nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+    # Индивидуальное расписание обновления: интервал подстраивается под частоту изменения цены.
+    # NULL в next_refresh_at - товар без подписчиков, плановое обновление приостановлено
+    refresh_interval = Column(Integer, nullable=False, default=3600, server_default='3600')
+    next_refresh_at = Column(DateTime, nullable=True, default=datetime.utcnow, index=True)
+    # Аренда товара воркером парсера: пока она не истекла, другие воркеры товар не берут
+    lease_owner = Column(String(64), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    # Валидаторы ответа product-details (ETag, Last-Modified) и хэш содержимого описания:
+    # при повторной загрузке описание записывается, только если оно изменилось
+    details_etag = Column(String(255), nullable=True)
+    details_last_modified = Column(String(64), nullable=True)
+    details_hash = Column(String(64), nullable=True)
+    details_refreshed_at = Column(DateTime, nullable=True)
+    # Статистика цены, обновляется парсером при каждой записи цены: предыдущая цена, исторические
+    # минимум и максимум, средняя за 30 дней (с учётом того, сколько держалась каждая цена),
+    # время последнего изменения и время последней проверки цены
+    previous_price = Column(DECIMAL(10, 2), nullable=True)
+    min_price = Column(DECIMAL(10, 2), nullable=True)
+    max_price = Column(DECIMAL(10, 2), nullable=True)
+    avg_price_30d = Column(DECIMAL(10, 2), nullable=True)
+    price_changed_at = Column(DateTime, nullable=True)
+    price_checked_at = Column(DateTime, nullable=True)
+
+
+# Модель подписки пользователя на товар
+class Product(Base):
+    __tablename__ = "products"
+
+    id = Column(Integer, primary_key=True, index=True)
+    url = Column(String(255), nullable=False)
     user_id = Column(String(255), nullable=False, index=True)
+    item_id = Column(String(64), ForeignKey("catalog_items.id"), nullable=False, index=True)
+
+    __table_args__ = (
+        # Проверка принадлежности и список подписок пользователя
+        Index('ix_products_user_id_id', 'user_id', 'id'),
+    )
+
+    item = relationship(CatalogItem, lazy="joined")
+
+    # Данные товара берутся из общего каталога
+    @property
+    def name(self):
+        return self.item.name
+
+    @property
+    def description(self):
+        return self.item.description
+
+    @property
+    def rating(self):
+        return self.item.rating
+
+    @property
+    def price(self):
+        return self.item.price
+
+    @property
+    def previous_price(self):
+        return self.item.previous_price
 
+    @property
+    def min_price(self):
+        return self.item.min_price
 
-# Модель истории цен
+    @property
+    def max_price(self):
+        return self.item.max_price
+
+    @property
+    def avg_price_30d(self):
+        return self.item.avg_price_30d
+
+    @property
+    def price_changed_at(self):
+        return self.item.price_changed_at
+
+
+# Модель истории цен, одна на товар каталога
 class PriceHistory(Base):
     __tablename__ = "price_history"
 
     id = Column(Integer, primary_key=True, index=True)
-    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    item_id = Column(String(64), ForeignKey("catalog_items.id"), nullable=False)
     price = Column(DECIMAL(10, 2), nullable=False)
     recorded_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # История товара за период и последняя записанная цена
+        Index('ix_price_history_item_id_recorded_at', 'item_id', 'recorded_at'),
+    )
+
+
+# Цены по дням, взвешенные временем: сумма цены, умноженной на число секунд, которые она держалась
+# между проверками, и сумма этих секунд. Из них считается средняя цена за 30 дней
+class PriceDailyStats(Base):
+    __tablename__ = "price_daily_stats"
+
+    item_id = Column(String(64), ForeignKey("catalog_items.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    price_seconds = Column(DECIMAL(20, 2), nullable=False)
+    seconds = Column(Integer, nullable=False)
+
+
+# Правило оповещения по подписке: target - цена опустилась до threshold, drop - снизилась
+# не меньше чем на threshold процентов, low - новый исторический минимум цены
+class PriceAlert(Base):
+    __tablename__ = "price_alerts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False, index=True)
+    rule = Column(String(16), nullable=False)
+    threshold = Column(DECIMAL(10, 2), nullable=True)
+    # Способ доставки: telegram - бот отправляет сообщение, api - оповещения забираются через GET /alerts/pending
+    channel = Column(String(16), nullable=False, default='telegram', server_default='telegram')
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Исходящие оповещения о снижении цены: парсер добавляет их в одной транзакции с новыми ценами,
+# бот (channel = telegram) или API (channel = api) отдаёт их пользователю и удаляет
+class AlertOutbox(Base):
+    __tablename__ = "alert_outbox"
+    __table_args__ = (
+        # Выборка оповещений одного способа доставки и пользователя
+        Index('ix_alert_outbox_channel_user_id', 'channel', 'user_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String(255), nullable=False)
+    channel = Column(String(16), nullable=False, default='telegram', server_default='telegram')
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    rule = Column(String(16), nullable=False)
+    old_price = Column(DECIMAL(10, 2), nullable=False)
+    new_price = Column(DECIMAL(10, 2), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 
 # Создание всех таблиц (если они еще не созданы)
 async def init_db():
     async with engine.begin() as conn:
+        # Блокировка держится до конца транзакции; остальные экземпляры ждут и видят готовую схему
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {'lock_id': SCHEMA_LOCK_ID})
         await conn.run_sync(Base.metadata.create_all)
 
 
+# Идентификатор товара М.Видео - число в конце пути ссылки после дефиса (.../products/<название>-<id>);
+# параметры запроса и фрагмент не учитываются. Для ссылок другого вида - None
+def extract_product_id(product_url):
+    match = re.search(r'-([0-9]+)$', urlsplit(product_url.strip()).path.rstrip('/'))
+    if match is None or len(match.group(1)) > CatalogItem.id.type.length:
+        return None
+    return match.group(1)
+
+
+# Добавление товаров в каталог при подписке. Товар, оставшийся без подписчиков,
+# снова ставится в расписание обновления
+def upsert_catalog_items(item_ids):
+    statement = insert(CatalogItem).values([{'id': item_id} for item_id in item_ids])
+    return statement.on_conflict_do_update(
+        index_elements=[CatalogItem.id],
+        set_={'next_refresh_at': func.coalesce(CatalogItem.next_refresh_at, datetime.utcnow())},
+    )
+
+
 # Асинхронная зависимость для создания сессии с базой данных
 async def get_db():
     async with SessionLocal() as db:
@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+import time
+from aiohttp import web
+
+# Записанные ответы сайта, на основе которых строятся ответы заглушки
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+# Локальная заглушка /bff/product-details и /bff/products/prices М.Видео для замеров парсера:
+# задержка ответа, доля ошибок 503, размер описания и ограничение частоты запросов (429 с Retry-After)
+class FakeMVideo:
+    def __init__(self, args):
+        self.latency = args.latency / 1000
+        self.error_rate = args.error_rate
+        self.payload_size = args.payload_size
+        self.rate_limit = args.rate_limit
+        self.price_change_rate = args.price_change_rate
+        with open(os.path.join(args.fixtures, 'product-details.json'), encoding='utf-8') as file:
+            self.details_fixture = json.load(file)
+        with open(os.path.join(args.fixtures, 'prices.json'), encoding='utf-8') as file:
+            self.prices_fixture = json.load(file)
+        self.prices = {}
+        self.requests = 0
+        self._tokens = self.rate_limit
+        self._tokens_updated_at = time.monotonic()
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/bff/product-details', self.product_details)
+        app.router.add_get('/bff/products/prices', self.products_prices)
+        return app
+
+    # Задержка, случайная ошибка или превышение ограничения частоты; None - отвечать как обычно
+    async def simulate_upstream(self):
+        self.requests += 1
+        if self.rate_limit > 0:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._tokens_updated_at) * self.rate_limit)
+            self._tokens_updated_at = now
+            if self._tokens < 1:
+                return web.Response(status=429, headers={'Retry-After': '1'})
+            self._tokens -= 1
+        if self.latency > 0:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.error_rate:
+            return web.Response(status=503)
+        return None
+
+    async def product_details(self, request):
+        error = await self.simulate_upstream()
+        if error is not None:
+            return error
+
+        product_id = request.query['productId']
+        etag = f'"{product_id}-1"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+
+        data = copy.deepcopy(self.details_fixture)
+        data['body']['productId'] = product_id
+        data['body']['name'] = f"{data['body']['name']} ({product_id})"
+        description = data['body']['description']
+        data['body']['description'] = description + ' ' * max(0, self.payload_size - len(description))
+        return web.json_response(data, headers={'ETag': etag})
+
+    async def products_prices(self, request):
+        error = await self.simulate_upstream()
+        if error is not None:
+            return error
+
+        template = self.prices_fixture['body']['materialPrices'][0]
+        material_prices = []
+        for product_id in request.query['productIds'].split(','):
+            price = self.prices.get(product_id, template['price']['salePrice'])
+            if random.random() < self.price_change_rate:
+                price = max(1, price + random.randint(-1000, 1000))
+            self.prices[product_id] = price
+            material_price = copy.deepcopy(template)
+            material_price['productId'] = product_id
+            material_price['price'].update(productId=product_id, salePrice=price)
+            material_prices.append(material_price)
+        data = copy.deepcopy(self.prices_fixture)
+        data['body']['materialPrices'] = material_prices
+        return web.json_response(data)
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=50, help="средняя задержка ответа, мс")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument('--payload-size', type=int, default=20_000, help="размер описания товара, символов")
+    parser.add_argument('--rate-limit', type=float, default=0, help="запросов в секунду до ответа 429, 0 - без ограничения")
+    parser.add_argument('--price-change-rate', type=float, default=0.1, help="доля товаров, цена которых меняется при запросе")
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help="каталог с записанными ответами сайта")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная заглушка API М.Видео для замеров парсера")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(FakeMVideo(args).create_app(), host=args.host, port=args.port)
@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+import asyncpg
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Отдельная схема, чтобы не трогать рабочие таблицы
+SCHEMA = 'bench_indexes'
+
+SETUP_SQL = [
+    f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE",
+    f"CREATE SCHEMA {SCHEMA}",
+    f"""
+    CREATE TABLE {SCHEMA}.products (
+        id SERIAL PRIMARY KEY,
+        url VARCHAR(255) NOT NULL,
+        user_id VARCHAR(255) NOT NULL,
+        item_id VARCHAR(64) NOT NULL
+    )
+    """,
+    f"""
+    CREATE TABLE {SCHEMA}.price_history (
+        id SERIAL PRIMARY KEY,
+        item_id VARCHAR(64) NOT NULL,
+        price NUMERIC(10, 2) NOT NULL,
+        recorded_at TIMESTAMP
+    )
+    """,
+    # Индексы, которые в схеме уже есть (index=True в моделях): замер сравнивает с ними, а не с полным
+    # просмотром таблицы, так что разница - вклад только составных индексов
+    f"CREATE INDEX ix_products_user_id ON {SCHEMA}.products (user_id)",
+    f"CREATE INDEX ix_products_item_id ON {SCHEMA}.products (item_id)",
+]
+
+# История по часам: rows записей, равномерно распределённых по items товарам
+FILL_SQL = [
+    f"""
+    INSERT INTO {SCHEMA}.price_history (item_id, price, recorded_at)
+    SELECT (i % $2)::text, 1000 + (random() * 100)::int, timestamp '2020-01-01' + (i / $2) * interval '1 hour'
+    FROM generate_series(0, $1 - 1) AS i
+    """,
+    f"""
+    INSERT INTO {SCHEMA}.products (url, user_id, item_id)
+    SELECT 'https://www.mvideo.ru/products/item-' || (i % $2), (i % $3)::text, (i % $2)::text
+    FROM generate_series(0, $1 - 1) AS i
+    """,
+]
+
+INDEXES_SQL = [
+    f"CREATE INDEX ix_price_history_item_id_recorded_at ON {SCHEMA}.price_history (item_id, recorded_at)",
+    f"CREATE INDEX ix_products_user_id_id ON {SCHEMA}.products (user_id, id)",
+]
+
+# Запросы сервисов, время которых сравнивается до и после создания индексов
+QUERIES = {
+    'история товара': (
+        f"SELECT id, item_id, price, recorded_at FROM {SCHEMA}.price_history WHERE item_id = $1 ORDER BY recorded_at",
+        lambda args: (str(random.randrange(args.items)),),
+    ),
+    'история за сутки': (
+        f"SELECT id, item_id, price, recorded_at FROM {SCHEMA}.price_history "
+        f"WHERE item_id = $1 AND recorded_at >= timestamp '2020-01-01' + $2 * interval '1 hour' "
+        f"AND recorded_at < timestamp '2020-01-02' + $2 * interval '1 hour' ORDER BY recorded_at",
+        lambda args: (str(random.randrange(args.items)), random.randrange(args.rows // args.items)),
+    ),
+    'последние цены пачки': (
+        f"SELECT DISTINCT ON (item_id) item_id, price, recorded_at FROM {SCHEMA}.price_history "
+        f"WHERE item_id = ANY($1) ORDER BY item_id, recorded_at DESC",
+        lambda args: ([str(random.randrange(args.items)) for _ in range(50)],),
+    ),
+    'товар пользователя': (
+        f"SELECT id FROM {SCHEMA}.products WHERE user_id = $1 AND id = $2",
+        lambda args: (str(random.randrange(args.users)), random.randrange(1, args.products + 1)),
+    ),
+    'подписки пользователя': (
+        f"SELECT id, url, item_id FROM {SCHEMA}.products WHERE user_id = $1 ORDER BY id LIMIT 50",
+        lambda args: (str(random.randrange(args.users)),),
+    ),
+}
+
+
+# Время выполнения каждого запроса в миллисекундах: медиана и p95 по repeat запускам
+async def measure(conn, args):
+    timings = {}
+    for title, (sql, make_params) in QUERIES.items():
+        samples = []
+        for _ in range(args.repeat):
+            params = make_params(args)
+            started_at = time.perf_counter()
+            await conn.fetch(sql, *params)
+            samples.append((time.perf_counter() - started_at) * 1000)
+        samples.sort()
+        timings[title] = (statistics.median(samples), samples[int(len(samples) * 0.95) - 1])
+    return timings
+
+
+async def run_benchmark(args):
+    conn = await asyncpg.connect(
+        user=os.getenv('DB_USER'), password=os.getenv('DB_PASSWORD'),
+        host=os.getenv('DB_HOST'), port=os.getenv('DB_PORT'), database=os.getenv('DB_NAME'),
+    )
+    try:
+        for statement in SETUP_SQL:
+            await conn.execute(statement)
+
+        started_at = time.perf_counter()
+        await conn.execute(FILL_SQL[0], args.rows, args.items)
+        await conn.execute(FILL_SQL[1], args.products, args.items, args.users)
+        await conn.execute(f"ANALYZE {SCHEMA}.price_history")
+        await conn.execute(f"ANALYZE {SCHEMA}.products")
+        print(f"Сгенерировано {args.rows} записей истории и {args.products} подписок "
+              f"за {time.perf_counter() - started_at:.1f} с")
+
+        before = await measure(conn, args)
+
+        started_at = time.perf_counter()
+        for statement in INDEXES_SQL:
+            await conn.execute(statement)
+        await conn.execute(f"ANALYZE {SCHEMA}.price_history")
+        await conn.execute(f"ANALYZE {SCHEMA}.products")
+        print(f"Индексы созданы за {time.perf_counter() - started_at:.1f} с")
+
+        after = await measure(conn, args)
+
+        print(f"\n{'запрос':<24}{'до, мс (p50/p95)':>22}{'после, мс (p50/p95)':>24}")
+        for title in QUERIES:
+            print(f"{title:<24}{before[title][0]:>12.2f} / {before[title][1]:<8.2f}"
+                  f"{after[title][0]:>13.2f} / {after[title][1]:<8.2f}")
+    finally:
+        if not args.keep:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Время запросов к истории цен до и после создания индексов")
+    parser.add_argument('--rows', type=int, default=10_000_000, help="записей в price_history")
+    parser.add_argument('--items', type=int, default=5_000, help="товаров каталога")
+    parser.add_argument('--products', type=int, default=100_000, help="подписок в products")
+    parser.add_argument('--users', type=int, default=10_000, help="пользователей")
+    parser.add_argument('--repeat', type=int, default=50, help="запусков каждого запроса")
+    parser.add_argument('--keep', action='store_true', help="не удалять схему с данными после замера")
+    asyncio.run(run_benchmark(parser.parse_args()))
@@ -0,0 +1,189 @@
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import sys
+import time
+from datetime import datetime
+import asyncpg
+from aiohttp import web
+from dotenv import load_dotenv
+from sqlalchemy import event
+from fake_mvideo import FakeMVideo, add_arguments
+
+load_dotenv()
+
+PARSER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'MVidParser')
+
+# Отдельная база, которая создаётся на время замера и удаляется после него
+BENCH_DATABASE = 'mvid_bench'
+
+
+def connect(database):
+    return asyncpg.connect(
+        user=os.getenv('DB_USER'), password=os.getenv('DB_PASSWORD'),
+        host=os.getenv('DB_HOST'), port=os.getenv('DB_PORT'), database=database,
+    )
+
+
+async def recreate_database(admin_database, create=True):
+    conn = await connect(admin_database)
+    try:
+        await conn.execute(f"DROP DATABASE IF EXISTS {BENCH_DATABASE}")
+        if create:
+            await conn.execute(f"CREATE DATABASE {BENCH_DATABASE}")
+    finally:
+        await conn.close()
+
+
+# Парсер читает параметры из окружения при импорте, поэтому импортируется после их настройки
+def import_parser(base_url):
+    os.environ['DB_NAME'] = BENCH_DATABASE
+    os.environ['PARSER_MVIDEO_BASE_URL'] = base_url
+    os.environ.setdefault('PARSER_HOST_RATE_LIMIT', '0')
+    os.environ.setdefault('PARSER_HISTORY_MODE', 'changes')
+    sys.path.insert(0, PARSER_DIR)
+    import main as parser
+    import models
+    return parser, models
+
+
+# count товаров каталога, срок обновления которых уже наступил, по одной подписке на каждый
+async def seed(conn, count, base_url):
+    # CASCADE очищает и таблицы со ссылками на подписки и каталог (оповещения, суммы цен за день)
+    await conn.execute("TRUNCATE price_history, products, catalog_items CASCADE")
+    now = datetime.utcnow()
+    item_ids = [str(400_000_000 + i) for i in range(count)]
+    await conn.copy_records_to_table(
+        'catalog_items', records=[(item_id, now) for item_id in item_ids], columns=['id', 'next_refresh_at']
+    )
+    await conn.copy_records_to_table(
+        'products', columns=['url', 'user_id', 'item_id'],
+        records=[(f"{base_url}/products/tovar-{item_id}", str(i % 1000), item_id) for i, item_id in enumerate(item_ids)],
+    )
+    await conn.execute("ANALYZE")
+
+
+async def reschedule_all(conn):
+    await conn.execute(
+        "UPDATE catalog_items SET next_refresh_at = $1, lease_owner = NULL, lease_expires_at = NULL",
+        datetime.utcnow(),
+    )
+
+
+# Замер прохода: время от постановки товара в очередь до записи его результатов
+# и число запросов к базе. Для этого оборачиваются submit_items и save_updates парсера
+class PassStats:
+    def __init__(self, parser, models):
+        self.submitted = {}
+        self.written = {}
+        self.round_trips = 0
+        submit_items = parser.submit_items
+        save_updates = parser.save_updates
+
+        async def timed_submit_items(refresher, items, priority):
+            now = time.perf_counter()
+            for item in items:
+                self.submitted.setdefault(item.id, now)
+            return await submit_items(refresher, items, priority)
+
+        async def timed_save_updates(db, updates):
+            await save_updates(db, updates)
+            now = time.perf_counter()
+            for item, _, _ in updates:
+                self.written[item.id] = now
+
+        parser.submit_items = timed_submit_items
+        parser.save_updates = timed_save_updates
+        event.listen(models.engine.sync_engine, 'before_cursor_execute', self.count_round_trip)
+
+    def count_round_trip(self, *args):
+        self.round_trips += 1
+
+    def reset(self):
+        self.submitted.clear()
+        self.written.clear()
+        self.round_trips = 0
+
+    def latencies(self):
+        return sorted(
+            (written_at - self.submitted[item_id]) * 1000
+            for item_id, written_at in self.written.items() if item_id in self.submitted
+        )
+
+
+async def run_pass(parser, refresher, stats):
+    stats.reset()
+    started_at = time.perf_counter()
+    while await parser.update_product_data(refresher) >= parser.CLAIM_BATCH_SIZE:
+        pass
+    await refresher.drain()
+    elapsed = time.perf_counter() - started_at
+
+    latencies = stats.latencies() or [0.0]
+    return {
+        'products': len(stats.written),
+        'per_second': len(stats.written) / elapsed,
+        'p50': statistics.median(latencies),
+        'p99': latencies[max(0, int(len(latencies) * 0.99) - 1)],
+        'round_trips': stats.round_trips,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+async def run_benchmark(args):
+    admin_database = os.getenv('DB_NAME')
+    runner = None
+    base_url = args.server_url
+    if base_url is None:
+        runner = web.AppRunner(FakeMVideo(args).create_app())
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        base_url = f"http://{host}:{port}"
+
+    await recreate_database(admin_database)
+    parser, models = import_parser(base_url)
+    try:
+        await parser.init_db()
+        conn = await connect(BENCH_DATABASE)
+        try:
+            async with parser.create_http_session() as session:
+                refresher = parser.RefreshEngine(session)
+                refresher.start()
+                stats = PassStats(parser, models)
+                print(f"{'товаров':>8}  {'проход':<10}{'записано':>9}{'товаров/с':>11}{'p50, мс':>10}"
+                      f"{'p99, мс':>10}{'запросов к БД':>15}{'пик RSS, МБ':>13}")
+                try:
+                    for count in args.products:
+                        await seed(conn, count, base_url)
+                        # Первый проход загружает описания и цены, повторный - только цены
+                        for title in ('первый', 'повторный'):
+                            result = await run_pass(parser, refresher, stats)
+                            print(f"{count:>8}  {title:<10}{result['products']:>9}{result['per_second']:>11.1f}"
+                                  f"{result['p50']:>10.1f}{result['p99']:>10.1f}{result['round_trips']:>15}"
+                                  f"{result['peak_rss']:>13.1f}")
+                            await reschedule_all(conn)
+                finally:
+                    await refresher.stop()
+        finally:
+            await conn.close()
+    finally:
+        await models.engine.dispose()
+        if runner is not None:
+            await runner.cleanup()
+        if not args.keep:
+            await recreate_database(admin_database, create=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Скорость обновления товаров парсером на локальной заглушке сайта")
+    parser.add_argument('--products', type=int, nargs='+', default=[1_000, 10_000],
+                        help="размеры каталога, например 1000 10000 100000")
+    parser.add_argument('--server-url', help="адрес заглушки, запущенной отдельно (fake_mvideo.py); "
+                                             "по умолчанию заглушка запускается в том же процессе")
+    parser.add_argument('--keep', action='store_true', help="не удалять базу с данными после замера")
+    add_arguments(parser)
+    asyncio.run(run_benchmark(parser.parse_args()))